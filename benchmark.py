@@ -0,0 +1,657 @@
+"""
+Local benchmarks for the MakeAppointment code hook in lambda_function.py.
+
+Usage:
+    python benchmark.py cold-start [--runs 20] [--path DIR]
+    python benchmark.py generate --output events.ndjson [--count 10000]
+    python benchmark.py replay [--events events.ndjson] [--count 10000] [--save-baseline FILE] [--compare FILE]
+    python benchmark.py responses [--count 20000]
+    python benchmark.py batch [--count 100000]
+    python benchmark.py check [--count 2000] [--seed 0] [--budget-scale 1.0] [--save-baseline FILE] [--compare FILE]
+
+cold-start imports lambda_function in a fresh interpreter and times the import and the first
+lambda_handler call, which is what a Lambda cold start pays before answering Lex. Point --path at
+another checkout of the repository to compare two versions.
+
+replay calls lambda_handler in-process on a corpus of Lex V2 events, either recorded (one JSON event
+per line, e.g. from the EVENT_LOG_SAMPLE_RATE dumps) or generated to cover every branch of
+make_appointment, and reports p50/p99 latency, events per second and peak allocated memory per
+scenario. --compare exits with status 1 when a scenario's p50 regressed past --max-regression.
+
+responses compares the prebuilt response fragments in lambda_function against building the same
+elicit_slot response from scratch, in time and in memory blocks allocated per response.
+
+batch checks the same (type, date, time) candidates with evaluate_batch and with one lambda_handler
+call per candidate, and reports the throughput of both.
+
+check runs the scheduling helpers (is_available, get_availabilities_for_duration, date parsing,
+validate_book_appointment on a freshly read event, and build_time_output_string) and the list-based versions
+lambda_function started from on the same random inputs, and times both. It exits with status 1
+when any answer differs, when a helper's time per call is over its budget in HELPER_BUDGETS (a multiple of
+the reference's time in the same run, scaled by --budget-scale), or with --compare when it regressed past
+--max-regression against the baseline.
+The references assume the default catalog (10:00 to 17:00 every 30 minutes), so run it without CATALOG_PATH.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+COLD_START_PROBE = '''
+import contextlib, io, json, sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import lambda_function
+imported = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    lambda_function.lambda_handler(json.loads(sys.argv[2]), None)
+done = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'first_invocation_ms': (done - imported) * 1000}))
+'''
+
+
+def next_weekday(after=None):
+    day = (after or datetime.date.today()) + datetime.timedelta(days=1)
+    while day.weekday() >= 5:
+        day += datetime.timedelta(days=1)
+    return day
+
+
+def slot_value(value):
+    if value is None:
+        return None
+    return {'value': {'originalValue': value, 'interpretedValue': value, 'resolvedValues': [value]}}
+
+
+def build_event(source, appointment_type=None, date=None, appointment_time=None, session_attributes=None,
+                intent_name='MakeAppointment', confirmation_state='None', session_id='benchmark-session'):
+    """
+    Build a Lex V2 code hook event for an intent (MakeAppointment by default).
+    """
+    return {
+        'messageVersion': '1.0',
+        'invocationSource': source,
+        'inputMode': 'Text',
+        'responseContentType': 'text/plain; charset=utf-8',
+        'sessionId': session_id,
+        'inputTranscript': '',
+        'bot': {'id': 'BENCHMARK', 'name': 'DentistBot', 'aliasId': 'TSTALIASID', 'localeId': 'en_US', 'version': 'DRAFT'},
+        'interpretations': [],
+        'sessionState': {
+            'sessionAttributes': session_attributes if session_attributes is not None else {},
+            'intent': {
+                'name': intent_name,
+                'slots': {
+                    'AppointmentType': slot_value(appointment_type),
+                    'Date': slot_value(date),
+                    'Time': slot_value(appointment_time)
+                },
+                'state': 'InProgress',
+                'confirmationState': confirmation_state
+            }
+        }
+    }
+
+
+def generate_scenarios():
+    """
+    Return (scenario name, event) pairs covering each branch of make_appointment.
+    """
+    import lambda_function
+
+    day = next_weekday().isoformat()
+    weekend_day = next_weekday() + datetime.timedelta(days=1)
+    while weekend_day.weekday() < 5:
+        weekend_day += datetime.timedelta(days=1)
+    # A day with nothing left, and a day whose only 60-minute window starts at 14:00
+    full_day = lambda_function.encode_booking_map({day: 0})
+    one_window_day = lambda_function.encode_booking_map({day: lambda_function.availabilities_to_mask(['14:00', '14:30'])})
+    # A session that booked a cleaning at 10:00 on day, which is no longer free in its bookingMap
+    booked = {
+        'appointment': 'cleaning|{}|{}|10:00'.format(day, lambda_function.PROVIDERS[0].provider_id),
+        'bookingMap': lambda_function.encode_booking_map({day: lambda_function.get_template_mask(next_weekday()) & ~1})
+    }
+
+    return [
+        ('elicit_type', build_event('DialogCodeHook')),
+        ('invalid_type', build_event('DialogCodeHook', 'braces')),
+        ('elicit_date', build_event('DialogCodeHook', 'cleaning')),
+        ('weekend_date', build_event('DialogCodeHook', 'cleaning', weekend_day.isoformat())),
+        ('no_availability', build_event('DialogCodeHook', 'root canal', day, session_attributes={'bookingMap': full_day})),
+        ('single_slot_confirm', build_event('DialogCodeHook', 'root canal', day, session_attributes={'bookingMap': one_window_day})),
+        ('multi_slot_elicit', build_event('DialogCodeHook', 'cleaning', day)),
+        ('time_available', build_event('DialogCodeHook', 'root canal', day, '10:00')),
+        ('time_unavailable', build_event('DialogCodeHook', 'cleaning', day, '12:30')),
+        ('fulfillment', build_event('FulfillmentCodeHook', 'whitening', day, '15:00')),
+        ('fulfillment_retry', build_event('FulfillmentCodeHook', 'whitening', day, '15:00', session_id='benchmark-retry')),
+        ('cancel_confirm', build_event('DialogCodeHook', session_attributes=dict(booked), intent_name='CancelAppointment')),
+        ('cancel_fulfillment', build_event('FulfillmentCodeHook', session_attributes=dict(booked),
+                                           intent_name='CancelAppointment', confirmation_state='Confirmed')),
+        ('reschedule_elicit_time', build_event('DialogCodeHook', None, day, session_attributes=dict(booked),
+                                               intent_name='RescheduleAppointment')),
+        ('reschedule_fulfillment', build_event('FulfillmentCodeHook', None, day, '15:00', session_attributes=dict(booked),
+                                               intent_name='RescheduleAppointment', confirmation_state='Confirmed')),
+    ]
+
+
+def load_corpus(args):
+    """
+    Return a list of (scenario name, serialized event). Recorded events are named after their invocation source.
+    """
+    if args.events:
+        corpus = []
+        with open(args.events) as events_file:
+            for line in events_file:
+                line = line.strip()
+                if line:
+                    event = json.loads(line)
+                    corpus.append((event.pop('_scenario', event.get('invocationSource', 'recorded')), json.dumps(event)))
+        return corpus
+
+    scenarios = [(name, json.dumps(event)) for name, event in generate_scenarios()]
+    rng = random.Random(args.seed)
+    return [rng.choice(scenarios) for _ in range(args.count)]
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_generate(args):
+    rng = random.Random(args.seed)
+    scenarios = generate_scenarios()
+    with open(args.output, 'w') as output:
+        for _ in range(args.count):
+            name, event = rng.choice(scenarios)
+            output.write(json.dumps(dict(event, _scenario=name)) + '\n')
+    print('wrote {} events to {}'.format(args.count, args.output))
+
+
+def load_event(name, serialized, index):
+    """
+    Decode a corpus event for one call. Each call gets a session of its own, so a repeated fulfillment is handled
+    rather than replayed from the fulfillment cache; *_retry scenarios keep theirs to measure the replays.
+    """
+    event = json.loads(serialized)
+    if not name.endswith('_retry'):
+        event['sessionId'] = '{}-{}'.format(event.get('sessionId'), index)
+    return event
+
+
+def run_replay(args):
+    sys.path.insert(0, args.path)
+    import lambda_function
+
+    corpus = load_corpus(args)
+    context = types.SimpleNamespace(aws_request_id='benchmark', function_name='MakeAppointmentCodeHook')
+    latencies = {}
+    peaks = {}
+
+    # Events are decoded before timing, as the Lambda runtime hands the handler an already parsed dict,
+    # and a fresh copy is used per call since the handler updates slots and session attributes in place.
+    with contextlib.redirect_stdout(io.StringIO()):
+        for index, (name, serialized) in enumerate(corpus[:args.warmup]):
+            lambda_function.lambda_handler(load_event(name, serialized, index), context)
+
+        started = time.perf_counter()
+        for index, (name, serialized) in enumerate(corpus):
+            event = load_event(name, serialized, index)
+            start = time.perf_counter()
+            lambda_function.lambda_handler(event, context)
+            latencies.setdefault(name, []).append((time.perf_counter() - start) * 1e6)
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        for index, (name, serialized) in enumerate(corpus[:args.memory_sample]):
+            event = load_event(name, serialized, index)
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            lambda_function.lambda_handler(event, context)
+            peaks.setdefault(name, []).append(tracemalloc.get_traced_memory()[1] - baseline)
+        tracemalloc.stop()
+
+    results = {}
+    print('{:<22} {:>7} {:>10} {:>10} {:>12}'.format('scenario', 'events', 'p50 us', 'p99 us', 'peak KiB'))
+    for name in sorted(latencies):
+        values = sorted(latencies[name])
+        results[name] = {'events': len(values), 'p50_us': percentile(values, 0.5), 'p99_us': percentile(values, 0.99)}
+        peak = statistics.mean(peaks[name]) / 1024 if name in peaks else float('nan')
+        print('{:<22} {:>7} {:>10.1f} {:>10.1f} {:>12.1f}'.format(
+            name, len(values), results[name]['p50_us'], results[name]['p99_us'], peak))
+
+    all_values = sorted(value for values in latencies.values() for value in values)
+    print('overall: {} events, p50 {:.1f} us, p99 {:.1f} us, {:.0f} events/s'.format(
+        len(all_values), percentile(all_values, 0.5), percentile(all_values, 0.99), len(all_values) / elapsed))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = [
+            '{}: p50 {:.1f} us -> {:.1f} us'.format(name, baseline[name]['p50_us'], result['p50_us'])
+            for name, result in results.items()
+            if name in baseline and result['p50_us'] > baseline[name]['p50_us'] * (1 + args.max_regression)
+        ]
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+def elicit_type_from_scratch(session_attributes, slots):
+    # The AppointmentType elicitation as it was built before response fragments were prebuilt
+    content = 'What type of appointment would you like to schedule?'
+    return {
+        'sessionState': {
+            'sessionAttributes': session_attributes,
+            'dialogAction': {'type': 'ElicitSlot', 'slotToElicit': 'AppointmentType'},
+            'intent': {'name': 'MakeAppointment', 'slots': slots, 'state': 'InProgress'}
+        },
+        'messages': [{'contentType': 'PlainText', 'content': content}],
+        'responseCard': {
+            'version': 1,
+            'contentType': 'application/vnd.amazonaws.card.generic',
+            'genericAttachments': [{
+                'title': 'Specify Appointment Type',
+                'subTitle': content,
+                'buttons': [
+                    {'text': 'cleaning (30 min)', 'value': 'cleaning'},
+                    {'text': 'root canal (60 min)', 'value': 'root canal'},
+                    {'text': 'whitening (30 min)', 'value': 'whitening'}
+                ]
+            }]
+        }
+    }
+
+
+def measure_builder(build, count):
+    """
+    Return (microseconds per response, memory blocks allocated per response) for build().
+    """
+    responses = []
+    blocks_before = sys.getallocatedblocks()
+    start = time.perf_counter()
+    for _ in range(count):
+        responses.append(build())
+    elapsed = time.perf_counter() - start
+    blocks = sys.getallocatedblocks() - blocks_before
+    return elapsed / count * 1e6, blocks / count
+
+
+def run_responses(args):
+    sys.path.insert(0, args.path)
+    import lambda_function
+
+    session_attributes = {}
+    slots = {'AppointmentType': None, 'Date': None, 'Time': None}
+    builders = [
+        ('from scratch', lambda: elicit_type_from_scratch(session_attributes, slots)),
+        ('prebuilt', lambda: lambda_function.elicit_slot(
+            session_attributes, 'MakeAppointment', slots, 'AppointmentType',
+            lambda_function.DEFAULT_LOCALE.messages['ask_appointment_type'],
+            lambda_function.DEFAULT_LOCALE.appointment_type_card
+        )),
+    ]
+    for name, build in builders:
+        assert json.dumps(build()) == json.dumps(builders[0][1]())
+        per_call_us, blocks = measure_builder(build, args.count)
+        print('{:<14} {:8.3f} us/response   {:6.1f} blocks/response'.format(name, per_call_us, blocks))
+
+
+def run_batch(args):
+    sys.path.insert(0, args.path)
+    import lambda_function
+
+    rng = random.Random(args.seed)
+    first_day = datetime.date.today()
+    appointment_types = ['cleaning', 'root canal', 'whitening']
+    times = ['{:02d}:{:02d}'.format(hour, minute) for hour in range(9, 18) for minute in (0, 30)]
+    candidates = [
+        (rng.choice(appointment_types), (first_day + datetime.timedelta(days=rng.randrange(45))).isoformat(), rng.choice(times))
+        for _ in range(args.count)
+    ]
+
+    start = time.perf_counter()
+    lambda_function.evaluate_batch(candidates)
+    batch_rate = len(candidates) / (time.perf_counter() - start)
+
+    handler_candidates = candidates[:args.handler_count]
+    events = [json.dumps(build_event('DialogCodeHook', *candidate)) for candidate in handler_candidates]
+    context = types.SimpleNamespace(aws_request_id='benchmark')
+    elapsed = 0.0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for serialized in events:
+            event = json.loads(serialized)
+            start = time.perf_counter()
+            lambda_function.lambda_handler(event, context)
+            elapsed += time.perf_counter() - start
+    handler_rate = len(events) / elapsed
+
+    print('evaluate_batch   {:>12.0f} candidates/s'.format(batch_rate))
+    print('lambda_handler   {:>12.0f} candidates/s'.format(handler_rate))
+    print('speedup          {:>12.1f}x'.format(batch_rate / handler_rate))
+
+
+# The helpers as lambda_function first implemented them, over lists of 'HH:MM' start times. check holds the
+# current helpers to their answers.
+REFERENCE_TIMES = ['{:02d}:{:02d}'.format(hour, minute) for hour in range(10, 17) for minute in (0, 30)]
+
+# Most time per call each helper may take, as a multiple of its reference's time in the same run. Being
+# relative, the budgets hold on any machine; each is under 1, so a helper slower than the code it replaced fails.
+HELPER_BUDGETS = {
+    'is_available': 0.8,
+    'get_availabilities_for_duration': 0.3,
+    'normalize_date': 0.6,
+    'validate_book_appointment': 0.9,
+    'build_time_output_string': 0.6,
+}
+
+
+def reference_increment_time_by_thirty_mins(appointment_time):
+    hour, minute = list(map(int, appointment_time.split(':')))
+    return '{}:00'.format(hour + 1) if minute == 30 else '{}:30'.format(hour)
+
+
+def reference_is_available(appointment_time, duration, availabilities):
+    if duration == 30:
+        return appointment_time in availabilities
+    elif duration == 60:
+        second_half_hour_time = reference_increment_time_by_thirty_mins(appointment_time)
+        return appointment_time in availabilities and second_half_hour_time in availabilities
+
+    raise Exception('Was not able to understand duration {}'.format(duration))
+
+
+def reference_get_availabilities_for_duration(duration, availabilities):
+    duration_availabilities = []
+    start_time = '10:00'
+    while start_time != '17:00':
+        if start_time in availabilities:
+            if duration == 30:
+                duration_availabilities.append(start_time)
+            elif reference_increment_time_by_thirty_mins(start_time) in availabilities:
+                duration_availabilities.append(start_time)
+
+        start_time = reference_increment_time_by_thirty_mins(start_time)
+
+    return duration_availabilities
+
+
+def reference_build_time_output_string(appointment_time):
+    hour, minute = appointment_time.split(':')
+    hour = int(hour)
+    minute = minute.zfill(2)
+
+    if hour > 12:
+        return '{}:{} p.m.'.format(hour - 12, minute)
+    elif hour == 12:
+        return '12:{} p.m.'.format(minute)
+    elif hour == 0:
+        return '12:{} a.m.'.format(minute)
+    else:
+        return '{}:{} a.m.'.format(hour, minute)
+
+
+def reference_normalize_date(date):
+    import dateutil.parser
+
+    try:
+        return datetime.datetime.strptime(date, '%Y-%m-%d').date()
+    except ValueError:
+        try:
+            return dateutil.parser.parse(date).date()
+        except (ValueError, OverflowError):
+            return None
+
+
+def reference_validate_book_appointment(appointment_type, date, appointment_time, today):
+    """
+    Return (isValid, violatedSlot) as the original validation did, with today in place of datetime.date.today().
+    """
+    import dateutil.parser
+
+    if appointment_type and appointment_type.lower() not in ('cleaning', 'root canal', 'whitening'):
+        return False, 'AppointmentType'
+
+    if appointment_time:
+        if len(appointment_time) != 5:
+            return False, 'Time'
+        try:
+            hour, minute = appointment_time.split(':')
+            hour, minute = int(hour), int(minute)
+        except ValueError:
+            return False, 'Time'
+        if hour < 10 or hour > 16 or minute not in (30, 0):
+            return False, 'Time'
+
+    if date:
+        parsed_date = reference_normalize_date(date)
+        if parsed_date is None:
+            return False, 'Date'
+        if parsed_date <= today or parsed_date.weekday() >= 5:
+            return False, 'Date'
+
+    return True, None
+
+
+def random_time(rng):
+    """
+    An 'HH:MM' time, usually on the reference grid, otherwise anywhere in the day and sometimes without the
+    hour's leading zero.
+    """
+    if rng.random() < 0.5:
+        return rng.choice(REFERENCE_TIMES)
+    hour, minute = rng.randrange(24), rng.randrange(60)
+    return ('{}:{:02d}' if rng.random() < 0.3 else '{:02d}:{:02d}').format(hour, minute)
+
+
+def random_availabilities(rng):
+    return [appointment_time for appointment_time in REFERENCE_TIMES if rng.random() < 0.6]
+
+
+def random_slot_values(rng, today):
+    """
+    AppointmentType, Date and Time slot values covering every outcome of validation.
+    """
+    appointment_type = rng.choice([None, 'cleaning', 'Root Canal', 'whitening', 'braces'])
+    appointment_time = rng.choice([None, random_time(rng), random_time(rng), '1030', '10:3', 'ab:cd', '10-30', '10h30'])
+    day = today + datetime.timedelta(days=rng.randrange(-3, 30))
+    date = rng.choice([
+        None, day.isoformat(), day.isoformat(), day.strftime('%m/%d/%Y'), day.strftime('%Y/%m/%d'),
+        day.isoformat() + 'T10:00', 'someday', '2031-02-30'
+    ])
+    return appointment_type, date, appointment_time
+
+
+def helper_checks(lambda_function, rng, count):
+    """
+    Return (helper name, current function, reference function, [(current args, reference args)], outcome), where
+    outcome turns a current result into the form the reference returns.
+    """
+    today = lambda_function.DEFAULT_CLINIC.today()
+    times = [(random_time(rng),) for _ in range(count)]
+    windows = [(rng.choice([30, 60]), random_availabilities(rng)) for _ in range(count)]
+    slot_values = [random_slot_values(rng, today) for _ in range(count)]
+    events = [build_event('DialogCodeHook', *values) for values in slot_values]
+    dates = [date for _, date, _ in slot_values if date]
+
+    def same(result):
+        return result
+
+    def parse_date(date):
+        # The uncached parse behind normalize_date, so repeated runs time parsing and not the memo.
+        return lambda_function.normalize_date_for_day.__wrapped__(date, today)
+
+    def validate_event(event):
+        # Reading the event normalizes the date, which the reference's time includes as well.
+        return lambda_function.validate_book_appointment(lambda_function.IntentRequest(event))
+
+    def validation_outcome(result):
+        return result['isValid'], result['violatedSlot']
+
+    return [
+        ('is_available', lambda_function.is_available, reference_is_available,
+         [((args[0],) + window, (args[0],) + window) for args, window in zip(times, windows)], same),
+        ('get_availabilities_for_duration', lambda_function.get_availabilities_for_duration,
+         reference_get_availabilities_for_duration, [(window, window) for window in windows], same),
+        ('normalize_date', parse_date, reference_normalize_date, [((date,), (date,)) for date in dates], same),
+        ('validate_book_appointment', validate_event, reference_validate_book_appointment,
+         [((event,), (appointment_type, date, appointment_time, today))
+          for event, (appointment_type, date, appointment_time) in zip(events, slot_values)],
+         validation_outcome),
+        ('build_time_output_string', lambda_function.build_time_output_string, reference_build_time_output_string,
+         [(args, args) for args in times], same),
+    ]
+
+
+def time_per_call(function, cases, repeat):
+    """
+    Return the best of repeat runs over cases, in microseconds per call.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for args in cases:
+            function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best / len(cases) * 1e6
+
+
+def run_check(args):
+    sys.path.insert(0, args.path)
+    import lambda_function
+
+    rng = random.Random(args.seed)
+    results = {}
+    mismatches = []
+    over_budget = []
+    print('{:<32} {:>7} {:>10} {:>10} {:>14} {:>8}'.format(
+        'helper', 'cases', 'mismatches', 'us/call', 'reference us', 'speedup'))
+    for name, current, reference, cases, outcome in helper_checks(lambda_function, rng, args.count):
+        wrong = [
+            (current_args, got, expected) for current_args, reference_args in cases
+            for got, expected in [(outcome(current(*current_args)), reference(*reference_args))]
+            if got != expected
+        ]
+        mismatches.extend((name,) + case for case in wrong)
+        # The runs of both alternate, so a slow spell on the machine slows them alike.
+        per_call_us = reference_us = float('inf')
+        for _ in range(args.repeat):
+            per_call_us = min(per_call_us, time_per_call(current, [current_args for current_args, _ in cases], 1))
+            reference_us = min(reference_us, time_per_call(reference, [reference_args for _, reference_args in cases], 1))
+        results[name] = {'cases': len(cases), 'us_per_call': per_call_us}
+        print('{:<32} {:>7} {:>10} {:>10.3f} {:>14.3f} {:>7.1f}x'.format(
+            name, len(cases), len(wrong), per_call_us, reference_us, reference_us / per_call_us))
+        budget = HELPER_BUDGETS[name] * args.budget_scale
+        if per_call_us > reference_us * budget:
+            over_budget.append('{}: {:.2f} times the reference, budget {:.2f}'.format(
+                name, per_call_us / reference_us, budget))
+
+    for name, current_args, got, expected in mismatches[:10]:
+        print('MISMATCH {}{}: {!r}, reference {!r}'.format(name, current_args, got, expected))
+    for problem in over_budget:
+        print('OVER BUDGET ' + problem)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+    regressions = []
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = [
+            '{}: {:.3f} us -> {:.3f} us per call'.format(name, baseline[name]['us_per_call'], result['us_per_call'])
+            for name, result in results.items()
+            if name in baseline and result['us_per_call'] > baseline[name]['us_per_call'] * (1 + args.max_regression)
+        ]
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+    if mismatches or over_budget or regressions:
+        sys.exit(1)
+
+
+def run_cold_start(args):
+    event = build_event('DialogCodeHook', 'cleaning', next_weekday().isoformat())
+    samples = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, '-c', COLD_START_PROBE, args.path, json.dumps(event)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    for key in ('import_ms', 'first_invocation_ms'):
+        values = sorted(sample[key] for sample in samples)
+        print('{:<20} median {:8.2f} ms   min {:8.2f} ms   max {:8.2f} ms'.format(
+            key, statistics.median(values), values[0], values[-1]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    cold_start = subparsers.add_parser('cold-start', help='time import and first invocation in fresh interpreters')
+    cold_start.add_argument('--runs', type=int, default=20)
+    cold_start.add_argument('--path', default=REPO_DIR, help='directory containing lambda_function.py')
+    cold_start.set_defaults(func=run_cold_start)
+
+    generate = subparsers.add_parser('generate', help='write a corpus of Lex V2 events as NDJSON')
+    generate.add_argument('--output', required=True)
+    generate.add_argument('--count', type=int, default=10000)
+    generate.add_argument('--seed', type=int, default=0)
+    generate.set_defaults(func=run_generate)
+
+    replay = subparsers.add_parser('replay', help='replay events through lambda_handler in-process')
+    replay.add_argument('--events', help='NDJSON file of recorded or generated events (default: generate in memory)')
+    replay.add_argument('--count', type=int, default=10000, help='number of generated events')
+    replay.add_argument('--seed', type=int, default=0)
+    replay.add_argument('--warmup', type=int, default=200)
+    replay.add_argument('--memory-sample', type=int, default=1000, help='events replayed again under tracemalloc')
+    replay.add_argument('--path', default=REPO_DIR, help='directory containing lambda_function.py')
+    replay.add_argument('--save-baseline', help='write per-scenario results to this JSON file')
+    replay.add_argument('--compare', help='baseline JSON file written by --save-baseline')
+    replay.add_argument('--max-regression', type=float, default=0.2, help='allowed p50 slowdown, as a fraction')
+    replay.set_defaults(func=run_replay)
+
+    responses = subparsers.add_parser('responses', help='compare prebuilt response fragments with building from scratch')
+    responses.add_argument('--count', type=int, default=20000)
+    responses.add_argument('--path', default=REPO_DIR, help='directory containing lambda_function.py')
+    responses.set_defaults(func=run_responses)
+
+    batch = subparsers.add_parser('batch', help='compare evaluate_batch with one lambda_handler call per candidate')
+    batch.add_argument('--count', type=int, default=100000)
+    batch.add_argument('--handler-count', type=int, default=10000, help='candidates sent through lambda_handler')
+    batch.add_argument('--seed', type=int, default=0)
+    batch.add_argument('--path', default=REPO_DIR, help='directory containing lambda_function.py')
+    batch.set_defaults(func=run_batch)
+
+    check = subparsers.add_parser('check', help='compare the scheduling helpers with their reference versions')
+    check.add_argument('--count', type=int, default=2000, help='random cases per helper')
+    check.add_argument('--seed', type=int, default=0)
+    check.add_argument('--repeat', type=int, default=5, help='timed runs per helper; the best one counts')
+    check.add_argument('--path', default=REPO_DIR, help='directory containing lambda_function.py')
+    check.add_argument('--budget-scale', type=float, default=1.0, help='multiplier applied to every HELPER_BUDGETS entry')
+    check.add_argument('--save-baseline', help='write per-helper times to this JSON file')
+    check.add_argument('--compare', help='baseline JSON file written by --save-baseline')
+    check.add_argument('--max-regression', type=float, default=0.2, help='allowed slowdown per call, as a fraction')
+    check.set_defaults(func=run_check)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
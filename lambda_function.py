@@ -1,25 +1,461 @@
 import json
-import dateutil.parser
+import functools
+import itertools
+import collections
+import base64
 import datetime
 import time
 import os
 import math
 import random
 import logging
+import zoneinfo
 
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+
+""" --- Logging: level and format come from the environment, and records are only formatted when emitted --- """
+
+# LOG_LEVEL is any logging level name. LOG_FORMAT is 'json' (default) or 'text' to keep the runtime's format.
+# EVENT_LOG_SAMPLE_RATE is the fraction of invocations, between 0 and 1, that log the full Lex event.
+EVENT_LOG_SAMPLE_RATE = float(os.environ.get('EVENT_LOG_SAMPLE_RATE', '0'))
+
+current_request_id = None
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    Format each record as one compact JSON object tagged with the invocation's request ID.
+    """
+    def format(self, record):
+        entry = {
+            'level': record.levelname,
+            'requestId': getattr(record, 'aws_request_id', None) or current_request_id,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+def configure_logging():
+    try:
+        logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    except ValueError:
+        logger.setLevel(logging.INFO)
+
+    if os.environ.get('LOG_FORMAT', 'json').lower() == 'json':
+        # Only the handlers the runtime installed are reformatted; none are added when run locally.
+        for handler in logger.handlers:
+            handler.setFormatter(JsonLogFormatter())
+
+def configure_local_logging():
+    """
+    Set up logging for the tools that run this module outside Lambda, where the root logger has no handler:
+    add one, then apply LOG_LEVEL and LOG_FORMAT to it.
+    """
+    logging.basicConfig()
+    configure_logging()
+
+def set_request_id(context):
+    global current_request_id
+    current_request_id = getattr(context, 'aws_request_id', None)
+
+configure_logging()
+
+""" --- Per-phase latency metrics, flushed once per invocation in CloudWatch Embedded Metric Format --- """
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'DentistBot')
+
+# phase -> [total milliseconds, call count] for the current invocation
+phase_timings = {}
+# counter name -> count for the current invocation
+metric_counts = {}
+
+def count_metric(name, count=1):
+    if METRICS_ENABLED:
+        metric_counts[name] = metric_counts.get(name, 0) + count
+
+def timed_phase(phase):
+    """
+    Decorator recording the time and call count of a phase of the turn. With metrics disabled the function
+    is returned as is, so the instrumentation costs nothing on the hot path.
+    """
+    def decorate(func):
+        if not METRICS_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = (time.perf_counter() - start) * 1000
+                totals = phase_timings.get(phase)
+                if totals is None:
+                    phase_timings[phase] = [elapsed, 1]
+                else:
+                    totals[0] += elapsed
+                    totals[1] += 1
+        return timed
+    return decorate
+
+def flush_metrics(intent_name, invocation_source):
+    """
+    Write the invocation's phase timings and counters to stdout as one EMF record and reset them.
+    """
+    if not METRICS_ENABLED:
+        return
+
+    metric_definitions = []
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Intent', 'InvocationSource']],
+                'Metrics': metric_definitions
+            }]
+        },
+        'Intent': intent_name,
+        'InvocationSource': invocation_source
+    }
+    for phase, (total, count) in phase_timings.items():
+        record[phase + 'Time'] = round(total, 3)
+        record[phase + 'Count'] = count
+        metric_definitions.append({'Name': phase + 'Time', 'Unit': 'Milliseconds'})
+        metric_definitions.append({'Name': phase + 'Count', 'Unit': 'Count'})
+    for name, count in metric_counts.items():
+        record[name] = count
+        metric_definitions.append({'Name': name, 'Unit': 'Count'})
+    phase_timings.clear()
+    metric_counts.clear()
+
+    print(json.dumps(record, separators=(',', ':')))
+
+# Everything below is built once per container and reused by warm invocations.
+
+DAY_STRINGS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+""" --- Service catalog and business hours, loaded once per container --- """
+
+# Used when no catalog file is deployed, and for any key a catalog file leaves out. Times are 'HH:MM',
+# hours are keyed by the lowercase DAY_STRINGS (days without hours are closed), and service durations
+# must be multiples of slotMinutes. Each provider (a dentist or chair) is booked independently; it may
+# list the services it performs and its own hours within the clinic's, and otherwise does everything.
+DEFAULT_CATALOG = {
+    'slotMinutes': 30,
+    'services': [
+        {'name': 'cleaning', 'minutes': 30},
+        {'name': 'root canal', 'minutes': 60},
+        {'name': 'whitening', 'minutes': 30}
+    ],
+    'hours': {day: ['10:00', '17:00'] for day in ('mon', 'tue', 'wed', 'thu', 'fri')},
+    'breaks': [['12:00', '14:00']],
+    'holidays': [],
+    'providers': [{'name': 'dentist'}]
+}
+
+def load_catalog():
+    """
+    Read the catalog from CATALOG_PATH, or from catalog.json next to this file, falling back to DEFAULT_CATALOG.
+    """
+    path = os.environ.get('CATALOG_PATH') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.json')
+    catalog = dict(DEFAULT_CATALOG)
+    if os.path.exists(path):
+        with open(path) as catalog_file:
+            catalog.update(json.load(catalog_file))
+    return catalog
+
+def clock_minutes(clock_time):
+    hour, minute = clock_time.split(':')
+    return int(hour) * 60 + int(minute)
+
+CATALOG = load_catalog()
+SLOT_MINUTES = CATALOG['slotMinutes']
+
+APPOINTMENT_DURATIONS = {}
+for service in CATALOG['services']:
+    if service['minutes'] <= 0 or service['minutes'] % SLOT_MINUTES:
+        raise ValueError('Duration of {} is not a multiple of {} minutes'.format(service['name'], SLOT_MINUTES))
+    APPOINTMENT_DURATIONS[service['name'].lower()] = service['minutes']
+
+# (open, close) minutes after midnight for each weekday, Monday first; None when closed.
+BUSINESS_HOURS = tuple(
+    tuple(clock_minutes(clock_time) for clock_time in CATALOG['hours'][day.lower()])
+    if CATALOG['hours'].get(day.lower()) else None
+    for day in DAY_STRINGS
+)
+if not any(BUSINESS_HOURS):
+    raise ValueError('The catalog has no business hours')
+BUSINESS_BREAKS = tuple(tuple(clock_minutes(clock_time) for clock_time in business_break) for business_break in CATALOG['breaks'])
+HOLIDAYS = frozenset(CATALOG['holidays'])
+
+# The slot grid spans the earliest opening to the latest closing of the week.
+BUSINESS_OPEN_MINUTES = min(hours[0] for hours in BUSINESS_HOURS if hours)
+BUSINESS_CLOSE_MINUTES = max(hours[1] for hours in BUSINESS_HOURS if hours)
+for hours in filter(None, BUSINESS_HOURS + BUSINESS_BREAKS):
+    if (hours[0] - BUSINESS_OPEN_MINUTES) % SLOT_MINUTES or (hours[1] - BUSINESS_OPEN_MINUTES) % SLOT_MINUTES:
+        raise ValueError('Business hours and breaks must fall on the {} minute slot grid'.format(SLOT_MINUTES))
+# Minutes past the hour at which slots start, for messages
+SLOT_START_MINUTES = sorted({(BUSINESS_OPEN_MINUTES + offset) % 60 for offset in range(0, 60, SLOT_MINUTES)})
+
+""" --- Clinics and their local clocks --- """
+def get_zone(timezone):
+    """
+    Return the tzinfo for an IANA timezone name. Falls back to the zone files bundled with dateutil when the
+    runtime has no system timezone database.
+    """
+    try:
+        return zoneinfo.ZoneInfo(timezone)
+    except zoneinfo.ZoneInfoNotFoundError:
+        import dateutil.tz
+        zone = dateutil.tz.gettz(timezone)
+        if zone is None:
+            raise ValueError('Unknown timezone {}'.format(timezone))
+        return zone
+
+# timezone name -> (today in that zone, epoch seconds of its next midnight)
+zone_today_cache = {}
+
+def today_in_zone(timezone, zone):
+    """
+    Return the current date in a timezone. It is computed once per zone and day, and recomputed after midnight.
+    """
+    now = time.time()
+    cached = zone_today_cache.get(timezone)
+    if cached is not None and now < cached[1]:
+        return cached[0]
+
+    today = datetime.datetime.fromtimestamp(now, zone).date()
+    next_midnight = datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time(), zone).timestamp()
+    zone_today_cache[timezone] = (today, next_midnight)
+    return today
+
+class Clinic:
+    """
+    A clinic served by this deployment: the key of its schedule in the availability backend and its timezone.
+    """
+    __slots__ = ('clinic_id', 'timezone', 'zone')
+
+    def __init__(self, clinic_id, timezone):
+        self.clinic_id = clinic_id
+        self.timezone = timezone
+        self.zone = get_zone(timezone)
+
+    def today(self):
+        return today_in_zone(self.timezone, self.zone)
+
+DEFAULT_CLINIC_ID = os.environ.get('DEFAULT_CLINIC_ID', 'default')
+DEFAULT_CLINIC = Clinic(DEFAULT_CLINIC_ID, os.environ.get('CLINIC_TIMEZONE', 'America/New_York'))
+# Other clinics served by the same deployment, selected by the clinicId session attribute.
+CLINICS = {
+    clinic_id: Clinic(clinic_id, timezone)
+    for clinic_id, timezone in json.loads(os.environ.get('CLINIC_TIMEZONES') or '{}').items()
+}
+CLINICS.setdefault(DEFAULT_CLINIC_ID, DEFAULT_CLINIC)
+
+def get_clinic(clinic_id):
+    """
+    Return the Clinic for a clinicId session attribute, or the default clinic when it is missing or unknown.
+    """
+    if not clinic_id:
+        return DEFAULT_CLINIC
+    clinic = CLINICS.get(clinic_id)
+    if clinic is None:
+        logger.warning('Unknown clinicId %s, using clinic %s', clinic_id, DEFAULT_CLINIC_ID)
+        return DEFAULT_CLINIC
+    return clinic
+
+""" --- User-facing text, per Lex localeId. Each locale is compiled once per container into a Locale below --- """
+
+# Used when no message catalog file is deployed, and for any key a file leaves out (a locale's missing messages
+# come from DEFAULT_LOCALE_ID). 'time' and 'date' render clock times and days; messages take their per-turn
+# values as {} placeholders, and the named fields {choices}, {open}, {close}, {slot_interval} and {slot_starts}
+# are filled in from the service catalog when the locale is compiled. 'services' maps a catalog service name to
+# the name shown to the customer; the catalog name stays the slot value, and is shown for services not listed.
+DEFAULT_MESSAGE_CATALOG = {
+    'en_US': {
+        'time': '{hour12}:{minute:02d} {period}',
+        'periods': ['a.m.', 'p.m.'],
+        'date': '{iso}',
+        'dayOption': '{month}-{day} ({weekday})',
+        'weekdays': list(DAY_STRINGS),
+        'or': ' or ',
+        'orLast': ', or ',
+        'confirmOptions': ['yes', 'no'],
+        'services': {},
+        'appointmentTypeOption': '{name} ({minutes} min)',
+        'messages': {
+            'ask_appointment_type': 'What type of appointment would you like to schedule?',
+            'ask_date': 'When would you like to schedule your {}?',
+            'ask_date_short': 'What day works best for you?',
+            'ask_time': 'What time on {} works for you? ',
+            'ask_time_short': 'What time works best for you?',
+            'unknown_appointment_type': 'I did not recognize that, can I book you a {choices}?',
+            'time_format': 'Please provide time in HH:MM format (e.g., 10:30)',
+            'time_invalid': 'Please provide a valid time in HH:MM format (e.g., 10:30)',
+            'time_outside_hours': 'Our business hours are from {open} to {close}; what time works best for you?',
+            'time_off_slot': 'We schedule appointments {slot_interval} ({slot_starts}). What time works best for you?',
+            'every_half_hour': 'every half hour',
+            'every_minutes': 'every {} minutes',
+            'time_unavailable': 'The time you requested is not available. ',
+            'date_not_understood': 'I did not understand that, what date works best for you?',
+            'date_too_soon': 'Appointments must be scheduled a day in advance. Can you try a different date?',
+            'date_weekend': 'Our office is not open on the weekends, can you provide a work day?',
+            'date_closed': 'Our office is closed on that day, can you provide another day?',
+            'date_parse_error': 'I had trouble understanding that date. Please provide a date in YYYY-MM-DD format.',
+            'date_full': 'We do not have any availability on that date, is there another day which works for you?',
+            'date_full_next_opening': 'We do not have any availability on that date. Our next opening is {} on {}, or is there another day which works for you?',
+            'only_availability': '{}{} is our only availability, does that work for you?',
+            'availability_two': 'We have availabilities at {} and {}',
+            'availability_three': 'We have availabilities at {}, {} and {}',
+            'availability_many': 'We have plenty of availability, including {}, {} and {}',
+            'confirm_appointment': 'Is {} on {} okay?',
+            'missing_information': 'Please provide all required information: appointment type, date, and time.',
+            'slot_taken': 'Sorry, {} on {} is no longer available. Please try again with a different time or date.',
+            'booked': 'Okay, I have booked your {} appointment. We will see you at {} on {}',
+            'processing': 'Processing your appointment request for {} at {} on {}.',
+            'booking_failed': 'I apologize, but I was unable to book your appointment. Please try again with a different time or date, or contact our office directly at (555) 123-4567 for assistance.',
+            'confirmed': 'Perfect! Your {} appointment has been confirmed for {} on {}. We look forward to seeing you! Please arrive 10 minutes before your appointment time.',
+            'no_booking': 'I could not find an upcoming appointment for you. Would you like to schedule one?',
+            'keep_appointment': 'Okay, your appointment has not been changed.',
+            'confirm_cancel': 'Cancel your {} appointment at {} on {}?',
+            'cancelled': 'Okay, I have cancelled your {} appointment at {} on {}.',
+            'cancel_failed': 'I was unable to cancel your appointment. Please contact our office directly at (555) 123-4567.',
+            'ask_reschedule_date': 'Your {} appointment is at {} on {}. What day would you like to move it to?',
+            'confirm_reschedule': 'Move your {} appointment from {} on {} to {} on {}?',
+            'rescheduled': 'Okay, I have moved your {} appointment to {} on {}.',
+            'reminder': 'Reminder: your {} appointment is at {} on {}. Please arrive 10 minutes before your appointment time.',
+            'rate_limited': 'You are sending messages faster than I can keep up. Please wait a moment and try again.',
+            # Response card titles; card_<slot> is used when eliciting that slot
+            'card_AppointmentType': 'Specify Appointment Type',
+            'card_Date': 'Specify Date',
+            'card_Time': 'Specify Time',
+            'card_confirm': 'Confirm Appointment',
+            'card_cancel': 'Confirm Cancellation'
+        }
+    },
+    'pt_BR': {
+        'time': '{hour}h{minute:02d}',
+        'periods': ['', ''],
+        'date': '{day:02d}/{month:02d}/{year}',
+        'dayOption': '{day:02d}/{month:02d} ({weekday})',
+        'weekdays': ['seg', 'ter', 'qua', 'qui', 'sex', 'sáb', 'dom'],
+        'or': ' ou ',
+        'orLast': ' ou ',
+        'confirmOptions': ['sim', 'não'],
+        'services': {'cleaning': 'limpeza', 'root canal': 'tratamento de canal', 'whitening': 'clareamento'},
+        'appointmentTypeOption': '{name} ({minutes} min)',
+        'messages': {
+            'ask_appointment_type': 'Que tipo de consulta você gostaria de agendar?',
+            'ask_date': 'Para quando você gostaria de agendar sua consulta de {}?',
+            'ask_date_short': 'Qual dia é melhor para você?',
+            'ask_time': 'Que horário em {} é bom para você? ',
+            'ask_time_short': 'Qual horário é melhor para você?',
+            'unknown_appointment_type': 'Não entendi. Posso agendar para você {choices}?',
+            'time_format': 'Informe o horário no formato HH:MM (por exemplo, 10:30)',
+            'time_invalid': 'Informe um horário válido no formato HH:MM (por exemplo, 10:30)',
+            'time_outside_hours': 'Nosso horário de atendimento é das {open} às {close}. Qual horário é melhor para você?',
+            'time_off_slot': 'Agendamos consultas {slot_interval} ({slot_starts}). Qual horário é melhor para você?',
+            'every_half_hour': 'a cada meia hora',
+            'every_minutes': 'a cada {} minutos',
+            'time_unavailable': 'O horário solicitado não está disponível. ',
+            'date_not_understood': 'Não entendi. Qual data é melhor para você?',
+            'date_too_soon': 'As consultas devem ser agendadas com um dia de antecedência. Pode tentar outra data?',
+            'date_weekend': 'Nosso consultório não abre nos fins de semana. Pode informar um dia útil?',
+            'date_closed': 'Nosso consultório está fechado nesse dia. Pode informar outro dia?',
+            'date_parse_error': 'Não consegui entender essa data. Informe a data no formato AAAA-MM-DD.',
+            'date_full': 'Não temos horários disponíveis nessa data. Outro dia seria bom para você?',
+            'date_full_next_opening': 'Não temos horários disponíveis nessa data. Nosso próximo horário livre é às {} em {}. Ou outro dia seria bom para você?',
+            'only_availability': '{}{} é nosso único horário disponível. Pode ser?',
+            'availability_two': 'Temos horários às {} e {}',
+            'availability_three': 'Temos horários às {}, {} e {}',
+            'availability_many': 'Temos bastante disponibilidade, incluindo {}, {} e {}',
+            'confirm_appointment': '{} em {} está bom?',
+            'missing_information': 'Informe todos os dados necessários: tipo de consulta, data e horário.',
+            'slot_taken': 'Desculpe, {} em {} não está mais disponível. Tente outro horário ou data.',
+            'booked': 'Pronto, sua consulta de {} está agendada. Esperamos você às {} em {}',
+            'processing': 'Processando seu pedido de consulta de {} às {} em {}.',
+            'booking_failed': 'Desculpe, não consegui agendar sua consulta. Tente outro horário ou data, ou ligue para o consultório no (555) 123-4567.',
+            'confirmed': 'Perfeito! Sua consulta de {} está confirmada para {} em {}. Aguardamos você! Chegue 10 minutos antes do horário.',
+            'no_booking': 'Não encontrei nenhuma consulta futura sua. Gostaria de agendar uma?',
+            'keep_appointment': 'Certo, sua consulta não foi alterada.',
+            'confirm_cancel': 'Cancelar sua consulta de {} às {} em {}?',
+            'cancelled': 'Pronto, cancelei sua consulta de {} às {} em {}.',
+            'cancel_failed': 'Não consegui cancelar sua consulta. Ligue para o consultório no (555) 123-4567.',
+            'ask_reschedule_date': 'Sua consulta de {} está marcada para {} em {}. Para qual dia você gostaria de mudá-la?',
+            'confirm_reschedule': 'Mudar sua consulta de {} de {} em {} para {} em {}?',
+            'rescheduled': 'Pronto, mudei sua consulta de {} para {} em {}.',
+            'reminder': 'Lembrete: sua consulta de {} é às {} em {}. Chegue 10 minutos antes do horário.',
+            'rate_limited': 'Você está enviando mensagens rápido demais. Aguarde um momento e tente novamente.',
+            'card_AppointmentType': 'Tipo de consulta',
+            'card_Date': 'Escolha a data',
+            'card_Time': 'Escolha o horário',
+            'card_confirm': 'Confirme a consulta',
+            'card_cancel': 'Confirme o cancelamento'
+        }
+    }
+}
+
+DEFAULT_LOCALE_ID = os.environ.get('DEFAULT_LOCALE', 'en_US')
+
+def load_message_catalog():
+    """
+    Read the message catalog from MESSAGE_CATALOG_PATH, or from messages.json next to this file, over
+    DEFAULT_MESSAGE_CATALOG. A locale's settings and messages are merged key by key over the built-in ones of
+    the same locale, or of DEFAULT_LOCALE_ID for a new locale.
+    """
+    path = os.environ.get('MESSAGE_CATALOG_PATH') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'messages.json')
+    overrides = {}
+    if os.path.exists(path):
+        with open(path) as catalog_file:
+            overrides = json.load(catalog_file)
+
+    fallback = DEFAULT_MESSAGE_CATALOG.get(DEFAULT_LOCALE_ID) or DEFAULT_MESSAGE_CATALOG['en_US']
+    catalog = {}
+    for locale_id in list(DEFAULT_MESSAGE_CATALOG) + [locale_id for locale_id in overrides if locale_id not in DEFAULT_MESSAGE_CATALOG]:
+        base = DEFAULT_MESSAGE_CATALOG.get(locale_id, fallback)
+        override = overrides.get(locale_id, {})
+        settings = dict(base, **override)
+        settings['messages'] = dict(fallback['messages'])
+        settings['messages'].update(base['messages'])
+        settings['messages'].update(override.get('messages', {}))
+        catalog[locale_id] = settings
+    return catalog
+
+def format_choices(choices, separator, last_separator):
+    if len(choices) <= 2:
+        return separator.join(choices)
+    return '{}{}{}'.format(', '.join(choices[:-1]), last_separator, choices[-1])
+
+def plain_text_message(content):
+    return {'contentType': 'PlainText', 'content': content}
+
+""" --- Prebuilt response fragments. They are shared by every response, so they must never be mutated --- """
+
+CONFIRM_INTENT_ACTION = {'type': 'ConfirmIntent'}
+CLOSE_ACTION = {'type': 'Close'}
+DELEGATE_ACTION = {'type': 'Delegate'}
+ELICIT_SLOT_ACTIONS = {slot: {'type': 'ElicitSlot', 'slotToElicit': slot} for slot in ('AppointmentType', 'Date', 'Time')}
+
+# Compact separators, with the encoder built once rather than per response.
+RESPONSE_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+def serialize_response(response):
+    """
+    Serialize a response for transports that need the JSON body themselves (the Lambda runtime does its own).
+    """
+    return RESPONSE_ENCODER.encode(response)
 
 """ --- Helpers to build responses which match the structure of the necessary dialog actions --- """
 
+@timed_phase('ElicitSlot')
 def elicit_slot(session_attributes, intent_name, slots, slot_to_elicit, message, response_card):
     return {
         'sessionState': {
             'sessionAttributes': session_attributes,
-            'dialogAction': {
-                'type': 'ElicitSlot',
-                'slotToElicit': slot_to_elicit
-            },
+            'dialogAction': ELICIT_SLOT_ACTIONS.get(slot_to_elicit) or {'type': 'ElicitSlot', 'slotToElicit': slot_to_elicit},
             'intent': {
                 'name': intent_name,
                 'slots': slots,
@@ -30,13 +466,12 @@ def elicit_slot(session_attributes, intent_name, slots, slot_to_elicit, message,
         'responseCard': response_card if response_card else None
     }
 
+@timed_phase('ConfirmIntent')
 def confirm_intent(session_attributes, intent_name, slots, message, response_card):
     return {
         'sessionState': {
             'sessionAttributes': session_attributes,
-            'dialogAction': {
-                'type': 'ConfirmIntent'
-            },
+            'dialogAction': CONFIRM_INTENT_ACTION,
             'intent': {
                 'name': intent_name,
                 'slots': slots,
@@ -47,18 +482,17 @@ def confirm_intent(session_attributes, intent_name, slots, message, response_car
         'responseCard': response_card if response_card else None
     }
 
-def close(session_attributes, fulfillment_state, message):
+@timed_phase('Close')
+def close(session_attributes, intent_name, fulfillment_state, message):
     # Log the fulfillment state to help diagnose issues
-    logger.debug(f"Closing with fulfillment state: {fulfillment_state}")
+    logger.debug('Closing with fulfillment state: %s', fulfillment_state)
     
     response = {
         'sessionState': {
             'sessionAttributes': session_attributes,
-            'dialogAction': {
-                'type': 'Close'
-            },
+            'dialogAction': CLOSE_ACTION,
             'intent': {
-                'name': 'MakeAppointment',
+                'name': intent_name,
                 'state': fulfillment_state
             },
             'messages': [message] if message else []
@@ -67,15 +501,14 @@ def close(session_attributes, fulfillment_state, message):
 
     return response
 
-def delegate(session_attributes, slots):
+@timed_phase('Delegate')
+def delegate(session_attributes, intent_name, slots):
     return {
         'sessionState': {
             'sessionAttributes': session_attributes,
-            'dialogAction': {
-                'type': 'Delegate'
-            },
+            'dialogAction': DELEGATE_ACTION,
             'intent': {
-                'name': 'MakeAppointment',
+                'name': intent_name,
                 'slots': slots,
                 'state': 'InProgress'
             }
@@ -102,6 +535,116 @@ def build_response_card(title, subtitle, options):
         }]
     }
 
+""" --- Locales: each message catalog entry compiled for the turns of that Lex localeId --- """
+
+# How many time labels a locale keeps, counting the slot grid's; times off the grid are remembered until then.
+TIME_LABEL_LIMIT = 4096
+
+class Locale:
+    """
+    The text of one locale, compiled once per container: messages fixed by the service catalog are filled in and
+    prebuilt, and so are the labels of every time on the slot grid and the options of the fixed response cards.
+    """
+    __slots__ = (
+        'locale_id', 'texts', 'messages', 'time_template', 'periods', 'date_template', 'day_option_template',
+        'weekdays', 'time_labels', 'service_names', 'confirm_options', 'appointment_type_options',
+        'appointment_type_card', 'slot_time_options'
+    )
+
+    def __init__(self, locale_id, settings):
+        self.locale_id = locale_id
+        self.time_template = settings['time']
+        self.periods = tuple(settings['periods'])
+        self.date_template = settings['date']
+        self.day_option_template = settings['dayOption']
+        self.weekdays = tuple(settings['weekdays'])
+        # Every time of day on the slot grid, which covers every time a customer can book
+        self.time_labels = {}
+        for minutes in range(BUSINESS_OPEN_MINUTES % SLOT_MINUTES, 24 * 60, SLOT_MINUTES):
+            self.time_labels['{:02d}:{:02d}'.format(*divmod(minutes, 60))] = self.render_time(*divmod(minutes, 60))
+
+        # Display name of each catalog service, keyed by its lowercase catalog name
+        self.service_names = {
+            service['name'].lower(): settings['services'].get(service['name'], service['name'])
+            for service in CATALOG['services']
+        }
+
+        messages = settings['messages']
+        fields = {
+            'choices': format_choices(list(self.service_names.values()), settings['or'], settings['orLast']),
+            'open': self.render_time(*divmod(BUSINESS_OPEN_MINUTES, 60)),
+            'close': self.render_time(*divmod(BUSINESS_CLOSE_MINUTES, 60)),
+            'slot_interval': messages['every_half_hour'] if SLOT_MINUTES == 30 else messages['every_minutes'].format(SLOT_MINUTES),
+            'slot_starts': format_choices(
+                ['XX:{:02d}'.format(minute) for minute in SLOT_START_MINUTES], settings['or'], settings['orLast']),
+        }
+        self.texts = {}
+        for key, text in messages.items():
+            for name, value in fields.items():
+                text = text.replace('{' + name + '}', value)
+            self.texts[key] = text
+        # Complete message objects for the texts without placeholders
+        self.messages = {key: plain_text_message(text) for key, text in self.texts.items() if '{}' not in text}
+
+        self.confirm_options = tuple({'text': option, 'value': option} for option in settings['confirmOptions'])
+        self.appointment_type_options = tuple(
+            {'text': settings['appointmentTypeOption'].format(
+                name=self.service_names[service['name'].lower()], minutes=service['minutes']),
+             'value': service['name']}
+            for service in CATALOG['services']
+        )
+        self.appointment_type_card = build_response_card(
+            self.texts['card_AppointmentType'], self.texts['ask_appointment_type'], self.appointment_type_options
+        )
+        # Time card option for each slot start, indexed by slot
+        self.slot_time_options = tuple(
+            {'text': self.format_time(slot_time), 'value': slot_time}
+            for slot_time in ('{:02d}:{:02d}'.format(*divmod(minutes, 60))
+                              for minutes in range(BUSINESS_OPEN_MINUTES, BUSINESS_CLOSE_MINUTES, SLOT_MINUTES))
+        )
+
+    def render_time(self, hour, minute):
+        return self.time_template.format(hour=hour, hour12=hour % 12 or 12, minute=minute, period=self.periods[hour >= 12])
+
+    def format_time(self, appointment_time):
+        """
+        Render an 'HH:MM' time, looking it up when it is on the slot grid or was rendered before.
+        """
+        label = self.time_labels.get(appointment_time)
+        if label is None:
+            hour, minute = appointment_time.split(':')
+            label = self.render_time(int(hour), int(minute))
+            if len(self.time_labels) < TIME_LABEL_LIMIT:
+                self.time_labels[appointment_time] = label
+        return label
+
+    def service_name(self, appointment_type):
+        """
+        Render an appointment type, as the customer gave it or as stored with a booking, by its display name.
+        """
+        service = appointment_type.lower()
+        return self.service_names.get(service, service)
+
+    def format_date(self, day):
+        return self.date_template.format(
+            iso=day.isoformat(), year=day.year, month=day.month, day=day.day, weekday=self.weekdays[day.weekday()]
+        )
+
+    def format_day_option(self, day):
+        return self.day_option_template.format(month=day.month, day=day.day, weekday=self.weekdays[day.weekday()])
+
+    def message(self, key, *values):
+        return plain_text_message(self.texts[key].format(*values))
+
+LOCALES = {locale_id: Locale(locale_id, settings) for locale_id, settings in load_message_catalog().items()}
+DEFAULT_LOCALE = LOCALES.get(DEFAULT_LOCALE_ID) or LOCALES['en_US']
+
+def get_locale(locale_id):
+    """
+    Return the Locale for a Lex localeId, or the default locale when the catalog has no text for it.
+    """
+    return LOCALES.get(locale_id) or DEFAULT_LOCALE
+
 """ --- Helper Functions --- """
 
 def parse_int(n):
@@ -123,106 +666,1074 @@ def try_ex(func):
 def get_slots(intent_request):
     return intent_request['sessionState']['intent']['slots']
 
-def get_slot(intent_request, slotName):
-    print(intent_request)
-    print(slotName)
-    slots = get_slots(intent_request)
-    print(slots)
-    
-    if slots is not None and slotName in slots and slots[slotName] is not None:
-        return slots[slotName]['value']['interpretedValue']
+def get_slot_value(slots, slotName):
+    if slots is not None and slots.get(slotName) is not None:
+        return slots[slotName]['value']['interpretedValue']
+    return None
+
+def get_slot(intent_request, slotName):
+    return get_slot_value(get_slots(intent_request), slotName)
+
+def get_session_attributes(intent_request):
+    sessionState = intent_request['sessionState']
+    if 'sessionAttributes' in sessionState:
+        return sessionState['sessionAttributes']
+    return {}
+
+class IntentRequest:
+    """
+    View of a Lex V2 code hook event, built once per invocation so handlers do not walk the event again.
+    slots and session_attributes are the event's own dicts, so changes to them end up in the response.
+    """
+    __slots__ = (
+        'event', 'intent_name', 'invocation_source', 'confirmation_state', 'session_id', 'customer_id', 'slots',
+        'session_attributes', 'locale', 'clinic', 'today', 'appointment_type', 'date', 'appointment_date', 'appointment_time'
+    )
+
+    def __init__(self, event):
+        session_state = event['sessionState']
+        intent = session_state['intent']
+        slots = intent.get('slots')
+
+        self.event = event
+        self.intent_name = intent.get('name')
+        self.invocation_source = event.get('invocationSource')
+        self.confirmation_state = intent.get('confirmationState')
+        self.session_id = event.get('sessionId')
+        self.slots = slots
+        self.session_attributes = session_state.get('sessionAttributes') or {}
+        self.locale = get_locale((event.get('bot') or {}).get('localeId'))
+        # Whose appointments a cancellation or reschedule looks up: the channel's customerId, else the Lex session
+        self.customer_id = self.session_attributes.get('customerId') or self.session_id
+        self.clinic = get_clinic(self.session_attributes.get('clinicId'))
+        # Relative dates and "a day in advance" are judged in the clinic's timezone
+        self.today = self.clinic.today()
+
+        self.appointment_type = get_slot_value(slots, 'AppointmentType')
+        # date is the raw slot value, appointment_date the datetime.date it was normalized to (None if unparseable)
+        self.date = get_slot_value(slots, 'Date')
+        self.appointment_date = normalize_date(self.date, self.today)
+        self.appointment_time = get_slot_value(slots, 'Time')
+
+def increment_time_by_thirty_mins(appointment_time):
+    hour, minute = list(map(int, appointment_time.split(':')))
+    return '{}:00'.format(hour + 1) if minute == 30 else '{}:30'.format(hour)
+
+def parse_date_fast(date):
+    """
+    Parse the formats Lex actually sends ('YYYY-MM-DD', optionally followed by a time, 'YYYY/MM/DD' and
+    'MM/DD/YYYY') without strptime or dateutil. Returns None for anything else.
+    """
+    if len(date) >= 10 and date[4] == date[7] and date[4] in '-/' and (len(date) == 10 or date[10] in 'T '):
+        year, month, day = date[0:4], date[5:7], date[8:10]
+    elif len(date) == 10 and date[2] == '/' and date[5] == '/':
+        month, day, year = date[0:2], date[3:5], date[6:10]
+    else:
+        return None
+
+    digits = year + month + day
+    if not (digits.isascii() and digits.isdecimal()):
+        return None
+    try:
+        return datetime.date(int(year), int(month), int(day))
+    except ValueError:
+        return None
+
+@functools.lru_cache(maxsize=512)
+def normalize_date_for_day(date, today):
+    # today is part of the cache key because dateutil fills missing fields (e.g. the year) from it, rather
+    # than from the process clock, which runs in UTC and not in the clinic's timezone.
+    parsed_date = parse_date_fast(date)
+    if parsed_date is not None:
+        return parsed_date
+
+    import dateutil.parser
+    try:
+        return dateutil.parser.parse(date, default=datetime.datetime.combine(today, datetime.time())).date()
+    except (ValueError, OverflowError):
+        return None
+
+@timed_phase('DateParsing')
+def normalize_date(date, today=None):
+    """
+    Return the datetime.date for a Lex date value, or None if it cannot be understood. Fast formats skip
+    dateutil entirely (it is only imported for fuzzy input), and results are memoized per value and day.
+    today defaults to the current day at the default clinic.
+    """
+    if not date or not isinstance(date, str):
+        return None
+    return normalize_date_for_day(date.strip(), today or DEFAULT_CLINIC.today())
+
+def get_random_int(minimum, maximum):
+    """
+    Returns a random integer between min (included) and max (excluded)
+    """
+    min_int = math.ceil(minimum)
+    max_int = math.floor(maximum)
+    return random.randint(min_int, max_int - 1)
+
+""" --- Availability engine: a day is a bitmask of fixed-width slots, bit i being the slot starting at SLOT_TIMES[i] --- """
+
+SLOT_COUNT = (BUSINESS_CLOSE_MINUTES - BUSINESS_OPEN_MINUTES) // SLOT_MINUTES
+# The bookingMap codec stores the slot count in one byte, and SQLite each provider's free slots in a signed
+# 64-bit INTEGER.
+if SLOT_COUNT > 255:
+    raise ValueError('The catalog has {} slots a day; at most 255 are supported'.format(SLOT_COUNT))
+if SLOT_COUNT > 63 and os.environ.get('AVAILABILITY_DB_PATH'):
+    raise ValueError(
+        'The catalog has {} slots a day; at most 63 are supported with AVAILABILITY_DB_PATH'.format(SLOT_COUNT))
+
+# 'HH:MM' label of every slot start, plus the closing time as a trailing entry.
+SLOT_TIMES = tuple(
+    '{:02d}:{:02d}'.format(*divmod(BUSINESS_OPEN_MINUTES + i * SLOT_MINUTES, 60)) for i in range(SLOT_COUNT + 1)
+)
+SLOT_INDEX = {slot_time: i for i, slot_time in enumerate(SLOT_TIMES[:SLOT_COUNT])}
+
+def time_to_slot(appointment_time):
+    """
+    Return the slot index of an 'HH:MM' time, or None if it does not start a slot within business hours.
+    """
+    return SLOT_INDEX.get(appointment_time)
+
+def slots_for_duration(duration):
+    if duration and duration % SLOT_MINUTES == 0:
+        return duration // SLOT_MINUTES
+    raise Exception('Was not able to understand duration {}'.format(duration))
+
+def window_mask(start_slot, slot_count):
+    return ((1 << slot_count) - 1) << start_slot
+
+def availabilities_to_mask(availabilities):
+    mask = 0
+    for appointment_time in availabilities:
+        slot = SLOT_INDEX.get(appointment_time)
+        if slot is not None:
+            mask |= 1 << slot
+    return mask
+
+def mask_to_availabilities(mask):
+    availabilities = []
+    while mask:
+        lowest = mask & -mask
+        availabilities.append(SLOT_TIMES[lowest.bit_length() - 1])
+        mask ^= lowest
+    return availabilities
+
+def fit_mask(mask, slot_count):
+    """
+    Return the mask of start slots from which slot_count contiguous slots are all free.
+    Bits past the closing time are always clear, so windows running over it never fit.
+    """
+    fits = mask
+    for offset in range(1, slot_count):
+        fits &= mask >> offset
+    return fits
+
+def get_start_times_for_duration(duration, mask):
+    return mask_to_availabilities(fit_mask(mask, slots_for_duration(duration)))
+
+def minutes_to_mask(start_minutes, end_minutes):
+    """
+    Return the mask of the slots between two times, given in minutes after midnight, clipped to the grid.
+    """
+    start_minutes = max(start_minutes, BUSINESS_OPEN_MINUTES)
+    end_minutes = min(end_minutes, BUSINESS_CLOSE_MINUTES)
+    if end_minutes <= start_minutes:
+        return 0
+    return window_mask(
+        (start_minutes - BUSINESS_OPEN_MINUTES) // SLOT_MINUTES, (end_minutes - start_minutes) // SLOT_MINUTES
+    )
+
+def build_weekday_mask(hours):
+    if hours is None:
+        return 0
+    mask = minutes_to_mask(*hours)
+    for business_break in BUSINESS_BREAKS:
+        mask &= ~minutes_to_mask(*business_break)
+    return mask
+
+# A day's mask packs one SLOT_COUNT-bit segment per provider, provider i's segment starting at bit
+# i * SLOT_COUNT, so a whole day still reads, books and travels as a single integer.
+SLOT_MASK = (1 << SLOT_COUNT) - 1
+CLINIC_WEEKDAY_MASKS = tuple(build_weekday_mask(hours) for hours in BUSINESS_HOURS)
+
+class Provider:
+    """
+    A dentist or chair from the catalog, with its segment of the day mask and its free slots per weekday.
+    """
+    __slots__ = ('provider_id', 'index', 'shift', 'services', 'weekday_masks')
+
+    def __init__(self, index, config):
+        self.provider_id = config['name']
+        self.index = index
+        self.shift = index * SLOT_COUNT
+        self.services = frozenset(service.lower() for service in config.get('services') or APPOINTMENT_DURATIONS)
+        unknown_services = self.services.difference(APPOINTMENT_DURATIONS)
+        if unknown_services:
+            raise ValueError('Provider {} offers unknown services {}'.format(self.provider_id, sorted(unknown_services)))
+
+        hours = config.get('hours')
+        self.weekday_masks = tuple(
+            clinic_mask if hours is None else clinic_mask & build_weekday_mask(
+                tuple(clock_minutes(clock_time) for clock_time in hours[day.lower()]) if hours.get(day.lower()) else None)
+            for day, clinic_mask in zip(DAY_STRINGS, CLINIC_WEEKDAY_MASKS)
+        )
+
+PROVIDERS = tuple(Provider(index, config) for index, config in enumerate(CATALOG['providers']))
+PROVIDERS_BY_ID = {provider.provider_id: provider for provider in PROVIDERS}
+PROVIDER_COUNT = len(PROVIDERS)
+if PROVIDER_COUNT > 255:
+    raise ValueError('The catalog has {} providers; the bookingMap codec supports at most 255'.format(PROVIDER_COUNT))
+# appointment type -> providers that perform it, in catalog order
+SERVICE_PROVIDERS = {
+    service: tuple(provider for provider in PROVIDERS if service in provider.services) for service in APPOINTMENT_DURATIONS
+}
+
+# Free slots of an untouched day for each weekday, Monday first, from the catalog's hours and breaks.
+WEEKDAY_AVAILABILITY_MASKS = tuple(
+    functools.reduce(lambda mask, provider: mask | provider.weekday_masks[weekday] << provider.shift, PROVIDERS, 0)
+    for weekday in range(7)
+)
+
+def get_template_mask(day):
+    """
+    Return the free slot mask of a datetime.date before anything is booked: its weekday's hours, or nothing
+    on a holiday.
+    """
+    if day.isoformat() in HOLIDAYS:
+        return 0
+    return WEEKDAY_AVAILABILITY_MASKS[day.weekday()]
+
+def provider_mask(mask, provider):
+    return mask >> provider.shift & SLOT_MASK
+
+def any_provider_mask(mask):
+    """
+    Return the slots that are free at one provider or more.
+    """
+    merged = 0
+    while mask:
+        merged |= mask & SLOT_MASK
+        mask >>= SLOT_COUNT
+    return merged
+
+def service_fit_mask(appointment_type, mask):
+    """
+    Return the start slots at which some provider performing appointment_type is free for its whole duration.
+    Each provider's fits are a few shifts of its segment, and the union across providers is already ordered by
+    time, so the earliest options are simply its lowest bits.
+    """
+    slot_count = slots_for_duration(get_duration(appointment_type))
+    fits = 0
+    for provider in SERVICE_PROVIDERS[appointment_type.lower()]:
+        fits |= fit_mask(provider_mask(mask, provider), slot_count)
+    return fits
+
+# The template backend only ever returns a handful of distinct masks (one per weekday, plus holidays).
+template_fit_mask = functools.lru_cache(maxsize=256)(service_fit_mask)
+
+def get_service_start_times(appointment_type, mask):
+    return mask_to_availabilities(service_fit_mask(appointment_type, mask))
+
+def find_free_providers(appointment_type, start_slot, mask):
+    """
+    Return the providers performing appointment_type that are free for its whole duration from start_slot.
+    """
+    window = window_mask(start_slot, slots_for_duration(get_duration(appointment_type)))
+    return [
+        provider for provider in SERVICE_PROVIDERS[appointment_type.lower()]
+        if mask >> provider.shift & window == window
+    ]
+
+def book_provider_window(mask, provider, start_slot, slot_count):
+    """
+    Return the day mask with a provider's window taken out. Raises ValueError if it is not free.
+    """
+    window = window_mask(start_slot, slot_count) << provider.shift
+    if mask & window != window:
+        raise ValueError('{} is not free for {} slots from {}'.format(provider.provider_id, slot_count, SLOT_TIMES[start_slot]))
+    return mask & ~window
+
+""" --- Session bookingMap codec --- """
+
+# The bookingMap session attribute maps 'YYYY-MM-DD' to the day's free slot mask, one segment per provider.
+# It is stored as 'b2:' + base64 of a one-byte slot count and a one-byte provider count followed by, per day,
+# a 2-byte day offset from BOOKING_MAP_EPOCH and the mask, both big-endian. 'b1:' maps (the same without
+# the provider count) and plain JSON ({date: ['HH:MM', ...]}) from older sessions describe a single provider,
+# so they are still accepted while the catalog has only one.
+BOOKING_MAP_CODEC_PREFIX = 'b2:'
+BOOKING_MAP_SINGLE_PROVIDER_PREFIX = 'b1:'
+BOOKING_MAP_EPOCH = datetime.date(2000, 1, 1).toordinal()
+BOOKING_MAP_MASK_BYTES = (SLOT_COUNT * PROVIDER_COUNT + 7) // 8
+BOOKING_MAP_ENTRY_BYTES = 2 + BOOKING_MAP_MASK_BYTES
+
+@timed_phase('BookingMapEncode')
+def encode_booking_map(booking_map):
+    payload = bytearray((SLOT_COUNT, PROVIDER_COUNT))
+    for date, mask in booking_map.items():
+        offset = datetime.date.fromisoformat(date).toordinal() - BOOKING_MAP_EPOCH
+        if 0 <= offset < 0x10000:
+            payload += offset.to_bytes(2, 'big') + mask.to_bytes(BOOKING_MAP_MASK_BYTES, 'big')
+    return BOOKING_MAP_CODEC_PREFIX + base64.b64encode(payload).decode('ascii')
+
+@timed_phase('BookingMapDecode')
+def decode_booking_map(encoded):
+    if not encoded:
+        return {}
+
+    try:
+        if encoded.startswith(BOOKING_MAP_CODEC_PREFIX):
+            payload = base64.b64decode(encoded[len(BOOKING_MAP_CODEC_PREFIX):])
+            header = (SLOT_COUNT, PROVIDER_COUNT)
+        elif PROVIDER_COUNT > 1:
+            # Written before there were several providers, so it cannot say whose slots were taken.
+            return {}
+        elif encoded.startswith(BOOKING_MAP_SINGLE_PROVIDER_PREFIX):
+            payload = base64.b64decode(encoded[len(BOOKING_MAP_SINGLE_PROVIDER_PREFIX):])
+            header = (SLOT_COUNT,)
+        else:
+            return {date: availabilities_to_mask(availabilities) for date, availabilities in json.loads(encoded).items()}
+
+        if tuple(payload[:len(header)]) != header:
+            # Encoded against a different slot grid or provider list, so the masks cannot be trusted; availability is rebuilt.
+            return {}
+
+        booking_map = {}
+        for start in range(len(header), len(payload) - BOOKING_MAP_ENTRY_BYTES + 1, BOOKING_MAP_ENTRY_BYTES):
+            offset = int.from_bytes(payload[start:start + 2], 'big')
+            date = datetime.date.fromordinal(BOOKING_MAP_EPOCH + offset).isoformat()
+            booking_map[date] = int.from_bytes(payload[start + 2:start + BOOKING_MAP_ENTRY_BYTES], 'big')
+        return booking_map
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.error('Error decoding bookingMap %s: %s', encoded, e)
+        return {}
+
+""" --- Availability backends --- """
+
+# How long a window offered for confirmation stays reserved for the session before others can take it.
+BOOKING_HOLD_SECONDS = float(os.environ.get('BOOKING_HOLD_SECONDS', 120))
+
+class Booking:
+    """
+    An appointment booked for a customer: the provider's window of slot_count slots from start_slot on day.
+    Sessions without a shared backend keep their latest one in the appointment session attribute, encoded as
+    'type|YYYY-MM-DD|provider|HH:MM'.
+    """
+    __slots__ = ('appointment_type', 'day', 'provider', 'start_slot', 'slot_count')
+
+    def __init__(self, appointment_type, day, provider, start_slot, slot_count):
+        self.appointment_type = appointment_type
+        self.day = day
+        self.provider = provider
+        self.start_slot = start_slot
+        self.slot_count = slot_count
+
+    @property
+    def window(self):
+        return window_mask(self.start_slot, self.slot_count)
+
+    @property
+    def time(self):
+        return SLOT_TIMES[self.start_slot]
+
+    def encode(self):
+        return '|'.join((self.appointment_type, self.day.isoformat(), self.provider.provider_id, self.time))
+
+    @classmethod
+    def decode(cls, encoded):
+        """
+        Return the Booking of an appointment session attribute, or None when it no longer fits the catalog.
+        """
+        try:
+            appointment_type, day, provider_id, appointment_time = encoded.split('|')
+            day = datetime.date.fromisoformat(day)
+        except (AttributeError, ValueError):
+            return None
+        provider = PROVIDERS_BY_ID.get(provider_id)
+        start_slot = SLOT_INDEX.get(appointment_time)
+        duration = get_duration(appointment_type)
+        if provider is None or start_slot is None or not duration:
+            return None
+        return cls(appointment_type, day, provider, start_slot, slots_for_duration(duration))
+
+class AvailabilityBackend:
+    """
+    Source of each day's free slots and the place bookings are written to. This default serves the catalog's
+    template and keeps no state, so bookings only live in each session's bookingMap.
+    Masks are whole days (every provider's segment), holds and bookings are for one Provider, and every method
+    takes the clinic_id of the clinic whose schedule is meant.
+    """
+    # Whether bookings are visible across sessions. A shared backend is always read fresh instead of
+    # trusting the per-session bookingMap.
+    shared = False
+
+    def get_day_mask(self, day, clinic_id=DEFAULT_CLINIC_ID):
+        """
+        Return the free slot mask for a datetime.date.
+        """
+        return get_template_mask(day)
+
+    def get_day_masks(self, first_day, day_count, clinic_id=DEFAULT_CLINIC_ID):
+        """
+        Return the free slot masks of day_count consecutive days starting at first_day.
+        """
+        return [self.get_day_mask(first_day + datetime.timedelta(days=offset), clinic_id) for offset in range(day_count)]
+
+    def get_fit_mask(self, day, appointment_type, mask, clinic_id=DEFAULT_CLINIC_ID):
+        """
+        Return service_fit_mask(appointment_type, mask) for the mask this backend just returned for the day.
+        """
+        return template_fit_mask(appointment_type, mask)
+
+    def hold(self, day, provider, start_slot, slot_count, session_id, clinic_id=DEFAULT_CLINIC_ID):
+        """
+        Reserve slot_count of the provider's slots from start_slot for session_id for BOOKING_HOLD_SECONDS,
+        replacing any earlier hold the session had on that day. Returns whether the slots are free and not held
+        by another session.
+        """
+        return True
+
+    def get_held_mask(self, day, session_id, clinic_id=DEFAULT_CLINIC_ID):
+        """
+        Return the day mask of the slots sessions other than session_id hold. This default keeps no holds.
+        """
+        return 0
+
+    def book(self, day, provider, start_slot, slot_count, session_id=None, clinic_id=DEFAULT_CLINIC_ID,
+             customer_id=None, appointment_type=None):
+        """
+        Take slot_count of the provider's slots from start_slot if they are all still free and not held by a
+        session other than session_id, recording the appointment for customer_id when one is given. Returns
+        whether the booking was made.
+        """
+        return True
+
+    def next_booking(self, customer_id, after_day, clinic_id=DEFAULT_CLINIC_ID):
+        """
+        Return the customer's first Booking on a day after after_day, or None. This default records no
+        bookings; sessions keep their own in the appointment session attribute.
+        """
+        return None
+
+    def cancel(self, booking, customer_id, clinic_id=DEFAULT_CLINIC_ID):
+        """
+        Free a Booking of customer_id. Returns whether it was still booked.
+        """
+        return True
+
+    def iter_bookings(self, first_day, last_day, clinic_id=DEFAULT_CLINIC_ID):
+        """
+        Yield (customer_id, Booking) for every booking from first_day to last_day inclusive, by day and then by
+        provider and start time, without reading them all at once.
+        """
+        return iter(())
+
+    def move(self, booking, day, provider, start_slot, customer_id, session_id=None, clinic_id=DEFAULT_CLINIC_ID):
+        """
+        Move a Booking of customer_id to the provider's window from start_slot on day in one step: either the
+        new window is taken and the old one freed, or nothing changes. Returns whether it was moved.
+        """
+        return True
+
+database_connections = {}
+
+def open_database(path):
+    """
+    Return the container's connection to the SQLite database at path, opening it on first use, so the
+    availability backend and the fulfillment cache share one.
+    """
+    connection = database_connections.get(path)
+    if connection is None:
+        # Only imported when a database is configured, so cold starts without one skip it.
+        import sqlite3
+        # Autocommit mode: every statement is its own atomic transaction unless one is begun explicitly.
+        connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        database_connections[path] = connection
+    return connection
+
+class SQLiteAvailabilityBackend(AvailabilityBackend):
+    """
+    Schedule shared by every session, stored as one free slot mask per clinic, day and provider in a SQLite
+    database in WAL mode. Providers are stored by name, so the catalog can reorder or add them. Days are
+    seeded from the catalog's template the first time they are read. Bookings take a window by a conditional
+    write on its free bits, and holds taken while a session confirms are kept in their own table.
+
+    This is a single-host stand-in: WAL mode needs every process using the file on one machine, and file locks
+    over NFS are unreliable in any journal mode, so the database must be on local disk (/tmp in a Lambda
+    container, or one file for the server.py workers of a machine), never on EFS or another network filesystem.
+    Sharing a schedule across Lambda containers takes a backend over a network database instead.
+    """
+    shared = True
+
+    def __init__(self, path):
+        self.connection = open_database(path)
+        self.check_grid(path)
+
+        columns = [column[1] for column in self.connection.execute('PRAGMA table_info(day_schedule)')]
+        if columns and 'provider' not in columns:
+            self.migrate_schedule(columns)
+        self.create_schedule_table('day_schedule')
+
+        if 'provider' not in [column[1] for column in self.connection.execute('PRAGMA table_info(slot_hold)')]:
+            # Holds last BOOKING_HOLD_SECONDS at most, so ones taken under an older schema are simply dropped.
+            self.connection.execute('DROP TABLE IF EXISTS slot_hold')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS slot_hold ('
+            'clinic_id TEXT NOT NULL, day TEXT NOT NULL, session_id TEXT NOT NULL, provider TEXT NOT NULL, '
+            'hold_mask INTEGER NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (clinic_id, day, session_id)) WITHOUT ROWID'
+        )
+        # Booked appointments, keyed by customer to find theirs and by slot to free or move one.
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS booking ('
+            'clinic_id TEXT NOT NULL, customer_id TEXT NOT NULL, day TEXT NOT NULL, start_slot INTEGER NOT NULL, '
+            'provider TEXT NOT NULL, slot_count INTEGER NOT NULL, appointment_type TEXT NOT NULL, '
+            'PRIMARY KEY (clinic_id, customer_id, day, start_slot, provider)) WITHOUT ROWID'
+        )
+        self.connection.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS booking_slot ON booking (clinic_id, day, provider, start_slot)'
+        )
+
+    def in_transaction(self, write, *args):
+        """
+        Run write(*args) as one transaction, committed only when it returns True.
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            done = write(*args)
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT' if done else 'ROLLBACK')
+        return done
+
+    def check_grid(self, path):
+        """
+        Record the slot grid the free masks and booking starts are written against, and refuse a database written
+        against another one: its bit positions would name other times. A database from before the grid was
+        recorded is taken to match the catalog.
+        """
+        grid = '{}:{}:{}'.format(SLOT_MINUTES, BUSINESS_OPEN_MINUTES, SLOT_COUNT)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS schedule_meta (name TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID'
+        )
+        self.connection.execute('INSERT OR IGNORE INTO schedule_meta (name, value) VALUES (?, ?)', ('grid', grid))
+        stored = self.connection.execute("SELECT value FROM schedule_meta WHERE name = 'grid'").fetchone()[0]
+        if stored != grid:
+            slot_minutes, open_minutes, slot_count = (int(value) for value in stored.split(':'))
+            raise ValueError(
+                'The database at {} holds a schedule of {} {}-minute slots from {:02d}:{:02d}, but the catalog has {} '
+                '{}-minute slots from {:02d}:{:02d}; start a new database to change the slot grid'.format(
+                    path, slot_count, slot_minutes, *divmod(open_minutes, 60), SLOT_COUNT, SLOT_MINUTES,
+                    *divmod(BUSINESS_OPEN_MINUTES, 60)))
+
+    def create_schedule_table(self, name):
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS {} ('
+            'clinic_id TEXT NOT NULL, day TEXT NOT NULL, provider TEXT NOT NULL, free_mask INTEGER NOT NULL, '
+            'PRIMARY KEY (clinic_id, day, provider)) WITHOUT ROWID'.format(name)
+        )
+
+    def migrate_schedule(self, columns):
+        """
+        Move a schedule written before providers (and possibly before clinics) existed to the first provider of
+        the default clinic.
+        """
+        clinic_id = 'clinic_id' if 'clinic_id' in columns else '?'
+        parameters = ((DEFAULT_CLINIC_ID,) if clinic_id == '?' else ()) + (PROVIDERS[0].provider_id,)
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.execute('ALTER TABLE day_schedule RENAME TO day_schedule_before_providers')
+            self.create_schedule_table('day_schedule')
+            self.connection.execute(
+                'INSERT INTO day_schedule (clinic_id, day, provider, free_mask) '
+                'SELECT {}, day, ?, free_mask FROM day_schedule_before_providers'.format(clinic_id),
+                parameters
+            )
+            self.connection.execute('DROP TABLE day_schedule_before_providers')
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def seed_day(self, day, clinic_id):
+        template = get_template_mask(day)
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO day_schedule (clinic_id, day, provider, free_mask) VALUES (?, ?, ?, ?)',
+            [(clinic_id, day.isoformat(), provider.provider_id, provider_mask(template, provider)) for provider in PROVIDERS]
+        )
+
+    @staticmethod
+    def merge_rows(template, rows):
+        """
+        Overlay stored (provider, free mask) rows on a day's template mask. Providers without a row yet (added to
+        the catalog since the day was seeded) keep their template, and rows of providers no longer in the
+        catalog are ignored.
+        """
+        mask = template
+        for provider_id, free_mask in rows:
+            provider = PROVIDERS_BY_ID.get(provider_id)
+            if provider is not None:
+                mask = mask & ~(SLOT_MASK << provider.shift) | free_mask << provider.shift
+        return mask
+
+    def get_day_mask(self, day, clinic_id=DEFAULT_CLINIC_ID):
+        rows = self.connection.execute(
+            'SELECT provider, free_mask FROM day_schedule WHERE clinic_id = ? AND day = ?', (clinic_id, day.isoformat())
+        ).fetchall()
+        if not rows:
+            self.seed_day(day, clinic_id)
+            return self.get_day_mask(day, clinic_id)
+        return self.merge_rows(get_template_mask(day), rows)
+
+    def get_day_masks(self, first_day, day_count, clinic_id=DEFAULT_CLINIC_ID):
+        # One range scan over the primary key; days never read before still have the template mask.
+        last_day = first_day + datetime.timedelta(days=day_count - 1)
+        stored = {}
+        for day, provider_id, free_mask in self.connection.execute(
+            'SELECT day, provider, free_mask FROM day_schedule WHERE clinic_id = ? AND day BETWEEN ? AND ?',
+            (clinic_id, first_day.isoformat(), last_day.isoformat())
+        ):
+            stored.setdefault(day, []).append((provider_id, free_mask))
+        days = [first_day + datetime.timedelta(days=offset) for offset in range(day_count)]
+        return [self.merge_rows(get_template_mask(day), stored.get(day.isoformat(), ())) for day in days]
+
+    def hold(self, day, provider, start_slot, slot_count, session_id, clinic_id=DEFAULT_CLINIC_ID):
+        self.seed_day(day, clinic_id)
+        window = window_mask(start_slot, slot_count)
+        now = time.time()
+        self.connection.execute('DELETE FROM slot_hold WHERE expires_at <= ?', (now,))
+        cursor = self.connection.execute(
+            'INSERT OR REPLACE INTO slot_hold (clinic_id, day, session_id, provider, hold_mask, expires_at) '
+            'SELECT ?, ?, ?, ?, ?, ? WHERE EXISTS ('
+            'SELECT 1 FROM day_schedule WHERE clinic_id = ? AND day = ? AND provider = ? AND free_mask & ? = ?) '
+            'AND NOT EXISTS ('
+            'SELECT 1 FROM slot_hold WHERE clinic_id = ? AND day = ? AND provider = ? AND session_id != ? '
+            'AND expires_at > ? AND hold_mask & ? != 0)',
+            (clinic_id, day.isoformat(), session_id, provider.provider_id, window, now + BOOKING_HOLD_SECONDS,
+             clinic_id, day.isoformat(), provider.provider_id, window, window,
+             clinic_id, day.isoformat(), provider.provider_id, session_id, now, window)
+        )
+        return cursor.rowcount == 1
+
+    def get_held_mask(self, day, session_id, clinic_id=DEFAULT_CLINIC_ID):
+        mask = 0
+        for provider_id, hold_mask in self.connection.execute(
+            'SELECT provider, hold_mask FROM slot_hold '
+            'WHERE clinic_id = ? AND day = ? AND session_id IS NOT ? AND expires_at > ?',
+            (clinic_id, day.isoformat(), session_id, time.time())
+        ):
+            provider = PROVIDERS_BY_ID.get(provider_id)
+            if provider is not None:
+                mask |= hold_mask << provider.shift
+        return mask
+
+    def book(self, day, provider, start_slot, slot_count, session_id=None, clinic_id=DEFAULT_CLINIC_ID,
+             customer_id=None, appointment_type=None):
+        self.seed_day(day, clinic_id)
+        booking = Booking(appointment_type, day, provider, start_slot, slot_count)
+        return self.in_transaction(self.take_window, booking, session_id, customer_id, clinic_id)
+
+    def take_window(self, booking, session_id, customer_id, clinic_id):
+        day = booking.day.isoformat()
+        window = booking.window
+        # Compare and swap the window's bits in one conditional write, so concurrent sessions cannot both
+        # get it and no lock is held between reading the schedule and booking.
+        cursor = self.connection.execute(
+            'UPDATE day_schedule SET free_mask = free_mask & ~? '
+            'WHERE clinic_id = ? AND day = ? AND provider = ? AND free_mask & ? = ? AND NOT EXISTS ('
+            'SELECT 1 FROM slot_hold WHERE slot_hold.clinic_id = day_schedule.clinic_id AND slot_hold.day = day_schedule.day '
+            'AND slot_hold.provider = day_schedule.provider AND session_id IS NOT ? AND expires_at > ? AND hold_mask & ? != 0)',
+            (window, clinic_id, day, booking.provider.provider_id, window, window, session_id, time.time(), window)
+        )
+        if cursor.rowcount != 1:
+            return False
+
+        if customer_id is not None:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO booking (clinic_id, customer_id, day, start_slot, provider, slot_count, appointment_type) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (clinic_id, customer_id, day, booking.start_slot, booking.provider.provider_id, booking.slot_count,
+                 booking.appointment_type)
+            )
+        if session_id is not None:
+            self.connection.execute(
+                'DELETE FROM slot_hold WHERE clinic_id = ? AND day = ? AND session_id = ?', (clinic_id, day, session_id)
+            )
+        return True
+
+    def free_window(self, booking, customer_id, clinic_id):
+        cursor = self.connection.execute(
+            'DELETE FROM booking WHERE clinic_id = ? AND day = ? AND provider = ? AND start_slot = ? AND customer_id = ?',
+            (clinic_id, booking.day.isoformat(), booking.provider.provider_id, booking.start_slot, customer_id)
+        )
+        if cursor.rowcount != 1:
+            return False
+
+        self.connection.execute(
+            'UPDATE day_schedule SET free_mask = free_mask | ? '
+            'WHERE clinic_id = ? AND day = ? AND provider = ?',
+            (booking.window, clinic_id, booking.day.isoformat(), booking.provider.provider_id)
+        )
+        return True
+
+    def next_booking(self, customer_id, after_day, clinic_id=DEFAULT_CLINIC_ID):
+        row = self.connection.execute(
+            'SELECT appointment_type, day, provider, start_slot, slot_count FROM booking '
+            'WHERE clinic_id = ? AND customer_id = ? AND day > ? ORDER BY day, start_slot LIMIT 1',
+            (clinic_id, customer_id, after_day.isoformat())
+        ).fetchone()
+        if row is None or row[2] not in PROVIDERS_BY_ID:
+            return None
+        return Booking(row[0], datetime.date.fromisoformat(row[1]), PROVIDERS_BY_ID[row[2]], row[3], row[4])
+
+    def cancel(self, booking, customer_id, clinic_id=DEFAULT_CLINIC_ID):
+        return self.in_transaction(self.free_window, booking, customer_id, clinic_id)
+
+    def iter_bookings(self, first_day, last_day, clinic_id=DEFAULT_CLINIC_ID):
+        # Follows the booking_slot index, so rows stream from the database with no sort. Bookings of providers
+        # no longer in the catalog are skipped.
+        cursor = self.connection.execute(
+            'SELECT customer_id, appointment_type, day, provider, start_slot, slot_count FROM booking '
+            'WHERE clinic_id = ? AND day BETWEEN ? AND ? ORDER BY day, provider, start_slot',
+            (clinic_id, first_day.isoformat(), last_day.isoformat())
+        )
+        for customer_id, appointment_type, day, provider_id, start_slot, slot_count in cursor:
+            provider = PROVIDERS_BY_ID.get(provider_id)
+            if provider is not None:
+                yield customer_id, Booking(appointment_type, datetime.date.fromisoformat(day), provider, start_slot, slot_count)
+
+    def move(self, booking, day, provider, start_slot, customer_id, session_id=None, clinic_id=DEFAULT_CLINIC_ID):
+        self.seed_day(day, clinic_id)
+        moved = Booking(booking.appointment_type, day, provider, start_slot, booking.slot_count)
+        # Freeing first lets the new window overlap the old one; if it cannot be taken the rollback rebooks the old.
+        return self.in_transaction(
+            lambda: self.free_window(booking, customer_id, clinic_id) and
+            self.take_window(moved, session_id, customer_id, clinic_id)
+        )
+
+AVAILABILITY_CACHE_SIZE = int(os.environ.get('AVAILABILITY_CACHE_SIZE', 512))
+AVAILABILITY_CACHE_TTL_SECONDS = float(os.environ.get('AVAILABILITY_CACHE_TTL_SECONDS', 30))
+
+class CachedAvailabilityBackend(AvailabilityBackend):
+    """
+    Bounded LRU in front of a shared backend, keyed by (clinic_id, day), holding the day mask and the start mask
+    of each appointment type asked for. Entries expire after ttl_seconds so bookings made by other processes
+    show up. Bookings, cancellations and moves made through this backend update the cached masks in place, and a
+    refused hold, booking or move drops the day, since another process changed it meanwhile.
+    """
+
+    def __init__(self, backend, max_entries, ttl_seconds):
+        self.backend = backend
+        self.shared = backend.shared
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # (clinic_id, day) -> [expires_at, day mask, {appointment type: start mask}]
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.updates = 0
+        self.invalidations = 0
+
+    def stats(self):
+        return {
+            'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            'updates': self.updates, 'invalidations': self.invalidations
+        }
+
+    def lookup(self, key, now):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= now:
+            self.misses += 1
+            count_metric('AvailabilityCacheMisses')
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        count_metric('AvailabilityCacheHits')
+        return entry
+
+    def store(self, key, mask, now):
+        entry = self.entries[key] = [now + self.ttl_seconds, mask, {}]
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def get_entry(self, day, clinic_id):
+        now = time.monotonic()
+        key = (clinic_id, day)
+        return self.lookup(key, now) or self.store(key, self.backend.get_day_mask(day, clinic_id), now)
+
+    def get_day_mask(self, day, clinic_id=DEFAULT_CLINIC_ID):
+        return self.get_entry(day, clinic_id)[1]
+
+    def get_day_masks(self, first_day, day_count, clinic_id=DEFAULT_CLINIC_ID):
+        # When any day of the range is missing, the whole range is read back in one backend call.
+        now = time.monotonic()
+        days = [first_day + datetime.timedelta(days=offset) for offset in range(day_count)]
+        entries = [self.lookup((clinic_id, day), now) for day in days]
+        if None in entries:
+            masks = self.backend.get_day_masks(first_day, day_count, clinic_id)
+            entries = [self.store((clinic_id, day), mask, now) for day, mask in zip(days, masks)]
+        return [entry[1] for entry in entries]
+
+    def get_fit_mask(self, day, appointment_type, mask, clinic_id=DEFAULT_CLINIC_ID):
+        # mask was just read through get_day_mask(s), which already counted the hit or miss for the day.
+        entry = self.entries.get((clinic_id, day))
+        service = appointment_type.lower()
+        if entry is None or entry[1] != mask:
+            return service_fit_mask(service, mask)
+        fits = entry[2].get(service)
+        if fits is None:
+            fits = entry[2][service] = service_fit_mask(service, entry[1])
+        return fits
+
+    def apply(self, day, provider, window, clinic_id, booked):
+        """
+        Take a provider's window out of a cached day (booked) or put it back (cancelled), recomputing only the
+        start masks of the types that provider performs.
+        """
+        entry = self.entries.get((clinic_id, day))
+        if entry is None:
+            return
+        if booked:
+            entry[1] &= ~(window << provider.shift)
+        else:
+            entry[1] |= window << provider.shift
+        for service in provider.services.intersection(entry[2]):
+            entry[2][service] = service_fit_mask(service, entry[1])
+        self.updates += 1
+
+    def invalidate(self, day, clinic_id):
+        if self.entries.pop((clinic_id, day), None) is not None:
+            self.invalidations += 1
+
+    def hold(self, day, provider, start_slot, slot_count, session_id, clinic_id=DEFAULT_CLINIC_ID):
+        held = self.backend.hold(day, provider, start_slot, slot_count, session_id, clinic_id)
+        if not held:
+            self.invalidate(day, clinic_id)
+        return held
+
+    def get_held_mask(self, day, session_id, clinic_id=DEFAULT_CLINIC_ID):
+        # Holds come and go within BOOKING_HOLD_SECONDS, so they are always read from the backend.
+        return self.backend.get_held_mask(day, session_id, clinic_id)
+
+    def book(self, day, provider, start_slot, slot_count, session_id=None, clinic_id=DEFAULT_CLINIC_ID,
+             customer_id=None, appointment_type=None):
+        booked = self.backend.book(day, provider, start_slot, slot_count, session_id, clinic_id, customer_id, appointment_type)
+        if booked:
+            self.apply(day, provider, window_mask(start_slot, slot_count), clinic_id, True)
+        else:
+            self.invalidate(day, clinic_id)
+        return booked
+
+    def next_booking(self, customer_id, after_day, clinic_id=DEFAULT_CLINIC_ID):
+        return self.backend.next_booking(customer_id, after_day, clinic_id)
+
+    def iter_bookings(self, first_day, last_day, clinic_id=DEFAULT_CLINIC_ID):
+        return self.backend.iter_bookings(first_day, last_day, clinic_id)
+
+    def cancel(self, booking, customer_id, clinic_id=DEFAULT_CLINIC_ID):
+        cancelled = self.backend.cancel(booking, customer_id, clinic_id)
+        if cancelled:
+            self.apply(booking.day, booking.provider, booking.window, clinic_id, False)
+        return cancelled
+
+    def move(self, booking, day, provider, start_slot, customer_id, session_id=None, clinic_id=DEFAULT_CLINIC_ID):
+        moved = self.backend.move(booking, day, provider, start_slot, customer_id, session_id, clinic_id)
+        if moved:
+            self.apply(booking.day, booking.provider, booking.window, clinic_id, False)
+            self.apply(day, provider, window_mask(start_slot, booking.slot_count), clinic_id, True)
+        else:
+            self.invalidate(day, clinic_id)
+        return moved
+
+availability_backend = None
+
+def get_availability_backend():
+    """
+    Return the container's backend, creating it on first use so warm invocations reuse the same connection.
+    Set AVAILABILITY_DB_PATH to share bookings through SQLite on this host; reads from it then go through the
+    availability cache unless AVAILABILITY_CACHE_SIZE or AVAILABILITY_CACHE_TTL_SECONDS is 0. The default
+    backend serves a precomputed template, so caching it would only add work.
+    """
+    global availability_backend
+    if availability_backend is None:
+        db_path = os.environ.get('AVAILABILITY_DB_PATH')
+        availability_backend = SQLiteAvailabilityBackend(db_path) if db_path else AvailabilityBackend()
+        if availability_backend.shared and AVAILABILITY_CACHE_SIZE > 0 and AVAILABILITY_CACHE_TTL_SECONDS > 0:
+            availability_backend = CachedAvailabilityBackend(
+                availability_backend, AVAILABILITY_CACHE_SIZE, AVAILABILITY_CACHE_TTL_SECONDS
+            )
+    return availability_backend
+
+@timed_phase('Availability')
+def get_day_mask(day, clinic=DEFAULT_CLINIC):
+    return get_availability_backend().get_day_mask(day, clinic.clinic_id)
+
+@timed_phase('Availability')
+def without_held(mask, day, session_id, clinic=DEFAULT_CLINIC):
+    """
+    Return a day mask without the slots other sessions hold while their customers confirm, so they are not offered.
+    """
+    return mask & ~get_availability_backend().get_held_mask(day, session_id, clinic.clinic_id)
+
+@timed_phase('Booking')
+def hold_appointment(day, appointment_type, start_slot, mask, session_id, clinic=DEFAULT_CLINIC):
+    """
+    Hold the first provider that performs appointment_type and is free from start_slot in mask. Returns that
+    Provider, or None when every such provider is already held by another session.
+    """
+    slot_count = slots_for_duration(get_duration(appointment_type))
+    backend = get_availability_backend()
+    for provider in find_free_providers(appointment_type, start_slot, mask):
+        if backend.hold(day, provider, start_slot, slot_count, session_id, clinic.clinic_id):
+            return provider
+    return None
+
+def candidate_providers(appointment_type, start_slot, mask, preferred=None):
+    """
+    Return the providers to try for appointment_type from start_slot, preferred first. When mask is given,
+    only providers free in it are returned.
+    """
+    if mask is None:
+        providers = list(SERVICE_PROVIDERS[appointment_type.lower()])
+    else:
+        providers = find_free_providers(appointment_type, start_slot, mask)
+    if preferred in providers:
+        providers.remove(preferred)
+        providers.insert(0, preferred)
+    return providers
+
+@timed_phase('Booking')
+def book_appointment(day, appointment_type, start_slot, session_id=None, clinic=DEFAULT_CLINIC, preferred_provider_id=None, mask=None,
+                     customer_id=None):
+    """
+    Book appointment_type from start_slot with a provider that performs it, trying the preferred provider (the
+    one held while the customer confirmed) first. When mask is given, only providers free in it are tried.
+    Returns the Provider booked, or None.
+    """
+    slot_count = slots_for_duration(get_duration(appointment_type))
+    backend = get_availability_backend()
+    for provider in candidate_providers(appointment_type, start_slot, mask, PROVIDERS_BY_ID.get(preferred_provider_id)):
+        if backend.book(day, provider, start_slot, slot_count, session_id, clinic.clinic_id, customer_id, appointment_type):
+            return provider
     return None
 
-def get_session_attributes(intent_request):
-    sessionState = intent_request['sessionState']
-    if 'sessionAttributes' in sessionState:
-        return sessionState['sessionAttributes']
-    return {}
+def find_booking(request):
+    """
+    Return the customer's next Booking after today at the request's clinic: from the shared backend's booking
+    index, or else from the appointment the session booked last.
+    """
+    backend = get_availability_backend()
+    if backend.shared:
+        return backend.next_booking(request.customer_id, request.today, request.clinic.clinic_id)
+    booking = Booking.decode(request.session_attributes.get('appointment'))
+    return booking if booking is not None and booking.day > request.today else None
 
-def increment_time_by_thirty_mins(appointment_time):
-    hour, minute = list(map(int, appointment_time.split(':')))
-    return '{}:00'.format(hour + 1) if minute == 30 else '{}:30'.format(hour)
+@timed_phase('Booking')
+def cancel_booking(booking, customer_id, clinic=DEFAULT_CLINIC):
+    return get_availability_backend().cancel(booking, customer_id, clinic.clinic_id)
 
-def get_random_int(minimum, maximum):
+@timed_phase('Booking')
+def move_booking(booking, day, start_slot, customer_id, session_id=None, clinic=DEFAULT_CLINIC, mask=None):
     """
-    Returns a random integer between min (included) and max (excluded)
+    Move booking to start_slot on day, keeping its provider when they are free there. When mask is given, only
+    providers free in it are tried. Returns the Provider it was moved to, or None.
     """
-    min_int = math.ceil(minimum)
-    max_int = math.floor(maximum)
-    return random.randint(min_int, max_int - 1)
+    backend = get_availability_backend()
+    for provider in candidate_providers(booking.appointment_type, start_slot, mask, booking.provider):
+        if backend.move(booking, day, provider, start_slot, customer_id, session_id, clinic.clinic_id):
+            return provider
+    return None
 
-def get_availabilities(date):
+def release_session_booking(session_attributes, booking_map, booking):
+    """
+    Give a cancelled or moved booking's window back in the session's bookingMap, for backends that keep no state.
+    """
+    date = booking.day.isoformat()
+    if date in booking_map:
+        booking_map[date] |= booking.window << booking.provider.shift
+        session_attributes['bookingMap'] = encode_booking_map(booking_map)
+
+""" --- Scheduling helpers --- """
+
+@timed_phase('Availability')
+def get_availabilities(date, clinic=DEFAULT_CLINIC):
     """
     Helper function which in a full implementation would feed into a backend API to provide query schedule availability.
     """
     try:
-        parsed_date = dateutil.parser.parse(date)
+        parsed_date = date if isinstance(date, datetime.date) else normalize_date(date, clinic.today())
         day_of_week = parsed_date.weekday()
-        logger.debug(f"Getting availabilities for date {date}, day of week: {day_of_week}")
+        logger.debug('Getting availabilities for date %s, day of week: %s', date, day_of_week)
         
-        availabilities = []
-        
-        # Generate some standard availability slots for all weekdays
-        if day_of_week < 5:  # Monday to Friday
-            # Morning slots
-            availabilities.extend(['10:00', '10:30', '11:00', '11:30'])
-            # Afternoon slots
-            availabilities.extend(['14:00', '14:30', '15:00', '15:30', '16:00', '16:30'])
-            
-            logger.debug(f"Generated availabilities for {date}: {availabilities}")
-            return availabilities
-        else:
-            logger.debug(f"No availabilities for weekend date {date}")
-            return []
+        availabilities = mask_to_availabilities(any_provider_mask(get_day_mask(parsed_date, clinic)))
+        logger.debug('Generated availabilities for %s: %s', date, availabilities)
+        return availabilities
             
     except Exception as e:
-        logger.error(f"Error generating availabilities for date {date}: {e}")
+        logger.error('Error generating availabilities for date %s: %s', date, e)
         return []
 
+# How far ahead find_next_availabilities looks, and how many days it reads from the backend at a time.
+SEARCH_HORIZON_DAYS = 60
+SEARCH_CHUNK_DAYS = 14
+
+@timed_phase('AvailabilitySearch')
+def find_next_availabilities(appointment_type, booking_map=None, limit=5, after_day=None, clinic=DEFAULT_CLINIC):
+    """
+    Scan forward from the day after after_day (default the clinic's today) and return up to limit (day, start
+    mask) pairs for the first days on which a provider has room for an appointment of the given type.
+    """
+    backend = get_availability_backend()
+    session_overlay = booking_map if booking_map and not backend.shared else None
+    first_day = (after_day or clinic.today()) + datetime.timedelta(days=1)
+
+    found = []
+    for chunk_start in range(0, SEARCH_HORIZON_DAYS, SEARCH_CHUNK_DAYS):
+        chunk_first_day = first_day + datetime.timedelta(days=chunk_start)
+        for offset, mask in enumerate(backend.get_day_masks(chunk_first_day, SEARCH_CHUNK_DAYS, clinic.clinic_id)):
+            day = chunk_first_day + datetime.timedelta(days=offset)
+            session_mask = session_overlay.get(day.isoformat()) if session_overlay else None
+            if session_mask is None:
+                starts = backend.get_fit_mask(day, appointment_type, mask, clinic.clinic_id)
+            else:
+                starts = service_fit_mask(appointment_type, session_mask)
+            if starts:
+                found.append((day, starts))
+                if len(found) == limit:
+                    return found
+    return found
+
 def isvalid_date(date):
-    try:
-        # First try parsing as ISO format
-        try:
-            datetime.datetime.strptime(date, '%Y-%m-%d')
-            return True
-        except ValueError:
-            # If ISO format fails, try other common formats
-            return bool(dateutil.parser.parse(date))
-    except (ValueError, TypeError):
-        return False
+    return normalize_date(date) is not None
 
 def is_available(appointment_time, duration, availabilities):
     """
     Helper function to check if the given time and duration fits within a known set of availability windows.
+    Only the window's own slots are looked up in availabilities.
     """
-    if duration == 30:
-        return appointment_time in availabilities
-    elif duration == 60:
-        second_half_hour_time = increment_time_by_thirty_mins(appointment_time)
-        return appointment_time in availabilities and second_half_hour_time in availabilities
-
-    raise Exception('Was not able to understand duration {}'.format(duration))
+    slot_count = slots_for_duration(duration)
+    start_slot = SLOT_INDEX.get(appointment_time)
+    if start_slot is None or start_slot + slot_count > SLOT_COUNT:
+        return False
+    for slot_time in SLOT_TIMES[start_slot:start_slot + slot_count]:
+        if slot_time not in availabilities:
+            return False
+    return True
 
 def get_duration(appointment_type):
-    appointment_duration_map = {'cleaning': 30, 'root canal': 60, 'whitening': 30}
-    return try_ex(lambda: appointment_duration_map[appointment_type.lower()])
+    return try_ex(lambda: APPOINTMENT_DURATIONS[appointment_type.lower()])
 
 def get_availabilities_for_duration(duration, availabilities):
     """
     Helper function to return the windows of availability of the given duration.
     """
-    duration_availabilities = []
-    start_time = '10:00'
-    while start_time != '17:00':
-        if start_time in availabilities:
-            if duration == 30:
-                duration_availabilities.append(start_time)
-            elif increment_time_by_thirty_mins(start_time) in availabilities:
-                duration_availabilities.append(start_time)
-
-        start_time = increment_time_by_thirty_mins(start_time)
-
-    return duration_availabilities
+    return get_start_times_for_duration(duration, availabilities_to_mask(availabilities))
 
 def build_validation_result(is_valid, violated_slot, message_content):
     return {
@@ -231,304 +1742,433 @@ def build_validation_result(is_valid, violated_slot, message_content):
         'message': {'contentType': 'PlainText', 'content': message_content}
     }
 
-def validate_book_appointment(intent_request):
-    appointment_type = get_slot(intent_request, 'AppointmentType')
-    date = get_slot(intent_request, 'Date')
-    appointment_time = get_slot(intent_request, 'Time')
+VALID_RESULT = build_validation_result(True, None, None)
+
+@functools.lru_cache(maxsize=None)
+def invalid_result(violated_slot, message_key, locale=DEFAULT_LOCALE):
+    """
+    Return the (shared) failed validation result for a slot and a message key of the locale.
+    """
+    return build_validation_result(False, violated_slot, locale.texts[message_key])
+
+@timed_phase('Validation')
+def validate_book_appointment(request):
+    """
+    Validate the slots of a MakeAppointment IntentRequest.
+    """
+    return validate_appointment(
+        request.appointment_type, request.date, request.appointment_date, request.appointment_time, request.today,
+        request.locale
+    )
+
+def validate_appointment(appointment_type, date, appointment_date, appointment_time, today=None, locale=DEFAULT_LOCALE):
+    """
+    Validate MakeAppointment slot values. appointment_date is date normalized by normalize_date, and today
+    defaults to the current day at the default clinic. Messages are in the given locale.
+    """
+    return (
+        validate_appointment_type(appointment_type, locale)
+        or validate_appointment_time(appointment_time, locale)
+        or validate_appointment_date(date, appointment_date, today or DEFAULT_CLINIC.today(), locale)
+        or VALID_RESULT
+    )
+
+# Each check below returns a failed validation result, or None when its slot is fine (or not filled yet).
 
+def validate_appointment_type(appointment_type, locale=DEFAULT_LOCALE):
     if appointment_type and not get_duration(appointment_type):
-        return build_validation_result(False, 'AppointmentType', 'I did not recognize that, can I book you a root canal, cleaning, or whitening?')
+        return invalid_result('AppointmentType', 'unknown_appointment_type', locale)
+    return None
 
-    if appointment_time:
-        try:
-            if len(appointment_time) != 5:
-                return build_validation_result(False, 'Time', 'Please provide time in HH:MM format (e.g., 10:30)')
+def validate_appointment_time(appointment_time, locale=DEFAULT_LOCALE):
+    if not appointment_time or appointment_time in SLOT_INDEX:
+        # Any start on the slot grid is a valid time; whether it is free is checked against the day's mask.
+        return None
 
-            hour, minute = appointment_time.split(':')
-            hour = parse_int(hour)
-            minute = parse_int(minute)
-            
-            if math.isnan(hour) or math.isnan(minute):
-                return build_validation_result(False, 'Time', 'Please provide a valid time in HH:MM format (e.g., 10:30)')
+    try:
+        if len(appointment_time) != 5 or appointment_time.count(':') != 1:
+            return invalid_result('Time', 'time_format', locale)
 
-            if hour < 10 or hour > 16:
-                return build_validation_result(False, 'Time', 'Our business hours are from 10:00 AM to 5:00 PM. What time works best for you?')
+        hour, minute = appointment_time.split(':')
+        hour = parse_int(hour)
+        minute = parse_int(minute)
 
-            if minute not in [30, 0]:
-                return build_validation_result(False, 'Time', 'We schedule appointments every half hour (XX:00 or XX:30). What time works best for you?')
-                
-            # Ensure the time is properly formatted
-            appointment_time = f"{hour:02d}:{minute:02d}"
-            
-        except Exception as e:
-            logger.error(f"Error validating time {appointment_time}: {e}")
-            return build_validation_result(False, 'Time', 'Please provide time in HH:MM format (e.g., 10:30)')
-
-    if date:
-        logger.debug(f"Validating date: {date}")
-        if not isvalid_date(date):
-            return build_validation_result(False, 'Date', 'I did not understand that, what date works best for you?')
-        
-        try:
-            # Try to parse the date in multiple formats
-            parsed_date = None
-            try:
-                parsed_date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
-            except ValueError:
-                parsed_date = dateutil.parser.parse(date).date()
-            
-            if parsed_date <= datetime.date.today():
-                return build_validation_result(False, 'Date', 'Appointments must be scheduled a day in advance. Can you try a different date?')
-            elif parsed_date.weekday() >= 5:  # 5 = Saturday, 6 = Sunday
-                return build_validation_result(False, 'Date', 'Our office is not open on the weekends, can you provide a work day?')
-            
-            logger.debug(f"Date validation successful for: {parsed_date}")
-        except (ValueError, TypeError) as e:
-            logger.error(f"Error parsing date: {e}")
-            return build_validation_result(False, 'Date', 'I did not understand that date format. Please provide a date like YYYY-MM-DD.')
+        if math.isnan(hour) or math.isnan(minute):
+            return invalid_result('Time', 'time_invalid', locale)
 
-    return build_validation_result(True, None, None)
+        minutes = hour * 60 + minute
+        if minutes < BUSINESS_OPEN_MINUTES or minutes >= BUSINESS_CLOSE_MINUTES:
+            return invalid_result('Time', 'time_outside_hours', locale)
 
-def build_time_output_string(appointment_time):
-    hour, minute = appointment_time.split(':')
-    hour = int(hour)
-    minute = minute.zfill(2)  # Ensure minutes are always 2 digits
-    
-    if hour > 12:
-        return '{}:{} p.m.'.format(hour - 12, minute)
-    elif hour == 12:
-        return '12:{} p.m.'.format(minute)
-    elif hour == 0:
-        return '12:{} a.m.'.format(minute)
-    else:
-        return '{}:{} a.m.'.format(hour, minute)
+        return invalid_result('Time', 'time_off_slot', locale)
+
+    except Exception as e:
+        logger.error('Error validating time %s: %s', appointment_time, e)
+        return invalid_result('Time', 'time_format', locale)
 
-def build_available_time_string(availabilities):
+def validate_appointment_date(date, appointment_date, today, locale=DEFAULT_LOCALE):
+    if not date:
+        return None
+
+    logger.debug('Validating date: %s', date)
+    if appointment_date is None:
+        return invalid_result('Date', 'date_not_understood', locale)
+
+    if appointment_date <= today:
+        return invalid_result('Date', 'date_too_soon', locale)
+    elif not get_template_mask(appointment_date):
+        # Closed that day: weekends get their own message when the office never opens on them
+        if (appointment_date.weekday() >= 5 and not any(WEEKDAY_AVAILABILITY_MASKS[5:]) and
+                appointment_date.isoformat() not in HOLIDAYS):
+            return invalid_result('Date', 'date_weekend', locale)
+        return invalid_result('Date', 'date_closed', locale)
+
+    logger.debug('Date validation successful for: %s', appointment_date)
+    return None
+
+def build_time_output_string(appointment_time, locale=DEFAULT_LOCALE):
+    return locale.format_time(appointment_time)
+
+def build_available_time_string(availabilities, locale=DEFAULT_LOCALE):
     """
     Build a string eliciting for a possible time slot among at least two availabilities.
     """
-    prefix = 'We have availabilities at '
+    labels = [locale.format_time(appointment_time) for appointment_time in availabilities[:3]]
     if len(availabilities) > 3:
-        prefix = 'We have plenty of availability, including '
-
-    prefix += build_time_output_string(availabilities[0])
+        return locale.texts['availability_many'].format(*labels)
     if len(availabilities) == 2:
-        return '{} and {}'.format(prefix, build_time_output_string(availabilities[1]))
+        return locale.texts['availability_two'].format(*labels)
+    return locale.texts['availability_three'].format(*labels)
 
-    return '{}, {} and {}'.format(prefix, build_time_output_string(availabilities[1]), build_time_output_string(availabilities[2]))
+""" --- Response card options: labels are built once, so a card is a few table lookups --- """
 
-def build_options(slot, appointment_type, date, booking_map):
+# Options on a date or time card, and how many open days the date card ranks to pick them.
+CARD_OPTION_COUNT = 5
+DATE_OPTION_CANDIDATES = 10
+
+def build_date_option(day, locale=DEFAULT_LOCALE):
+    return {'text': locale.format_day_option(day), 'value': day.isoformat()}
+
+@functools.lru_cache(maxsize=16)
+def get_upcoming_business_days(today, locale=DEFAULT_LOCALE):
+    """
+    Return {day: date card option} for the days after today within SEARCH_HORIZON_DAYS on which the office
+    opens, in date order. Built once per date and locale and shared by every clinic on that date.
+    """
+    days = (today + datetime.timedelta(days=offset) for offset in range(1, SEARCH_HORIZON_DAYS + 1))
+    return {day: build_date_option(day, locale) for day in days if get_template_mask(day)}
+
+def rank_by_density(found, limit):
+    """
+    Order (day, start mask) pairs by how many start times each day still has, busiest days last; days with as
+    many starts keep their date order.
+    """
+    return sorted(found, key=lambda day_starts: -bin(day_starts[1]).count('1'))[:limit]
+
+@timed_phase('ResponseOptions')
+def build_options(slot, appointment_type, date, booking_map, clinic=DEFAULT_CLINIC, locale=DEFAULT_LOCALE,
+                  session_id=None):
     """
-    Build a list of potential options for a given slot, to be used in responseCard generation.
+    Build a list of potential options for a given slot, to be used in responseCard generation. Given the
+    session_id, times other sessions hold are left out.
     """
-    day_strings = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
     if slot == 'AppointmentType':
+        return list(locale.appointment_type_options)
+    elif slot == 'Date':
+        today = clinic.today()
+        upcoming_days = get_upcoming_business_days(today, locale)
+        if not (appointment_type and get_duration(appointment_type)):
+            return list(itertools.islice(upcoming_days.values(), CARD_OPTION_COUNT))
+
+        # Only offer days that still have room for this appointment type, the emptiest first
+        found = find_next_availabilities(appointment_type, booking_map, limit=DATE_OPTION_CANDIDATES, clinic=clinic)
         return [
-            {'text': 'cleaning (30 min)', 'value': 'cleaning'},
-            {'text': 'root canal (60 min)', 'value': 'root canal'},
-            {'text': 'whitening (30 min)', 'value': 'whitening'}
+            upcoming_days.get(day) or build_date_option(day, locale)
+            for day, _ in rank_by_density(found, CARD_OPTION_COUNT)
         ]
-    elif slot == 'Date':
-        options = []
-        potential_date = datetime.date.today()
-        while len(options) < 5:
-            potential_date = potential_date + datetime.timedelta(days=1)
-            if potential_date.weekday() < 5:
-                options.append({
-                    'text': '{}-{} ({})'.format((potential_date.month), potential_date.day, day_strings[potential_date.weekday()]),
-                    'value': potential_date.strftime('%Y-%m-%d')
-                })
-        return options
     elif slot == 'Time':
         if not appointment_type or not date:
             return None
 
         availabilities = try_ex(lambda: booking_map[date])
+        appointment_date = normalize_date(date, clinic.today())
+        if availabilities is None and appointment_date is not None:
+            availabilities = get_day_mask(appointment_date, clinic)
+        if availabilities and session_id is not None and appointment_date is not None:
+            availabilities = without_held(availabilities, appointment_date, session_id, clinic)
         if not availabilities:
             return None
 
-        availabilities = get_availabilities_for_duration(get_duration(appointment_type), availabilities)
-        if len(availabilities) == 0:
-            return None
+        return build_time_options(service_fit_mask(appointment_type, availabilities), locale)
+
+def build_time_options(starts, locale=DEFAULT_LOCALE):
+    """
+    Return the time card options for a start mask; it is in time order, so its lowest bits are the earliest.
+    """
+    options = []
+    while starts and len(options) < CARD_OPTION_COUNT:
+        lowest = starts & -starts
+        options.append(locale.slot_time_options[lowest.bit_length() - 1])
+        starts ^= lowest
+    return options or None
+
+""" --- Batch evaluation for tooling that checks many candidate appointments at once --- """
 
-        options = []
-        for i in range(min(len(availabilities), 5)):
-            options.append({'text': build_time_output_string(availabilities[i]), 'value': availabilities[i]})
+def evaluate_batch(candidates, clinic=DEFAULT_CLINIC, locale=DEFAULT_LOCALE):
+    """
+    Validate many candidate appointments and check their availability without going through Lex events.
+    Each candidate is a dict keyed by slot name (AppointmentType, Date and optionally Time) or an
+    (appointment_type, date, time) tuple. Returns one dict per candidate with isValid, violatedSlot and
+    message, plus 'available' when a time was given or 'availableTimes' (start times that fit the
+    appointment type) when it was not.
+
+    Dates are judged, and availability read, at the given clinic, and messages are in the given locale. Every
+    check is computed once per distinct value in the batch (type, time, date, each date's mask, and date and type
+    for the fit across providers), so each candidate costs a few dict lookups and one bit test.
+    """
+    today = clinic.today()
+    type_checks = {}
+    time_checks = {}
+    date_checks = {}
+    day_masks = {}
+    day_fits = {}
+    results = []
+    for candidate in candidates:
+        if isinstance(candidate, dict):
+            appointment_type = candidate.get('AppointmentType')
+            date = candidate.get('Date')
+            appointment_time = candidate.get('Time')
+        else:
+            appointment_type, date, appointment_time = (tuple(candidate) + (None, None, None))[:3]
+
+        if appointment_type not in type_checks:
+            type_checks[appointment_type] = (
+                validate_appointment_type(appointment_type, locale),
+                appointment_type.lower() if get_duration(appointment_type or '') else None
+            )
+        type_failure, service = type_checks[appointment_type]
+
+        if appointment_time not in time_checks:
+            time_checks[appointment_time] = (validate_appointment_time(appointment_time, locale), time_to_slot(appointment_time))
+        time_failure, start_slot = time_checks[appointment_time]
+
+        if date not in date_checks:
+            appointment_date = normalize_date(date, today)
+            date_checks[date] = (validate_appointment_date(date, appointment_date, today, locale), appointment_date)
+        date_failure, appointment_date = date_checks[date]
 
-        return options
+        validation_result = type_failure or time_failure or date_failure or VALID_RESULT
+        result = {
+            'isValid': validation_result['isValid'],
+            'violatedSlot': validation_result['violatedSlot'],
+            'message': validation_result['message']['content']
+        }
+
+        if validation_result is VALID_RESULT and service and appointment_date is not None:
+            starts = day_fits.get((appointment_date, service))
+            if starts is None:
+                if appointment_date not in day_masks:
+                    day_masks[appointment_date] = get_day_mask(appointment_date, clinic)
+                starts = day_fits[(appointment_date, service)] = service_fit_mask(service, day_masks[appointment_date])
+
+            if appointment_time:
+                result['available'] = start_slot is not None and bool(starts >> start_slot & 1)
+            else:
+                result['availableTimes'] = mask_to_availabilities(starts)
 
-def make_appointment(intent_request):
+        results.append(result)
+    return results
+
+@timed_phase('MakeAppointment')
+def make_appointment(request):
     """
     Performs dialog management and fulfillment for booking a dentist appointment.
     """
-    # Debug the entire intent request to see what's happening
-    logger.debug(f"FULL INTENT REQUEST: {json.dumps(intent_request)}")
-    session_attributes = get_session_attributes(intent_request)
-    slots = get_slots(intent_request)
+    session_attributes = request.session_attributes
+    slots = request.slots
+    clinic = request.clinic
+    locale = request.locale
     
-    appointment_type = get_slot(intent_request, 'AppointmentType')
-    date = get_slot(intent_request, 'Date')
-    appointment_time = get_slot(intent_request, 'Time')
+    appointment_type = request.appointment_type
+    date = request.date
+    appointment_time = request.appointment_time
     
-    logger.debug(f"Processing appointment request - Type: {appointment_type}, Date: {date}, Time: {appointment_time}")
+    logger.debug('Processing appointment request - Type: %s, Date: %s, Time: %s', appointment_type, date, appointment_time)
     
-    # Convert date to standard format if needed
-    if date:
-        try:
-            parsed_date = dateutil.parser.parse(date)
-            date = parsed_date.strftime('%Y-%m-%d')
-            logger.debug(f"Standardized date format: {date}")
-        except Exception as e:
-            logger.error(f"Error parsing date {date}: {e}")
+    # The date was parsed once when the request was read; use the standard format for the rest of the turn
+    appointment_date = request.appointment_date
+    if appointment_date is not None:
+        date = appointment_date.isoformat()
+        logger.debug('Standardized date format: %s', date)
+    elif date:
+        logger.error('Error parsing date %s', date)
     
-    source = intent_request.get('invocationSource')
-    logger.debug(f"Invocation source in make_appointment: {source}")
-    booking_map = json.loads(session_attributes.get('bookingMap', '{}'))
+    source = request.invocation_source
+    logger.debug('Invocation source in make_appointment: %s', source)
+    booking_map = decode_booking_map(session_attributes.get('bookingMap'))
 
     if source == 'DialogCodeHook':
-        validation_result = validate_book_appointment(intent_request)
+        validation_result = validate_book_appointment(request)
         if not validation_result['isValid']:
             slots[validation_result['violatedSlot']] = None
             return elicit_slot(
                 session_attributes,
-                'MakeAppointment',
+                request.intent_name,
                 slots,
                 validation_result['violatedSlot'],
                 validation_result['message'],
                 build_response_card(
-                    'Specify {}'.format(validation_result['violatedSlot']),
+                    locale.texts['card_' + validation_result['violatedSlot']],
                     validation_result['message']['content'],
-                    build_options(validation_result['violatedSlot'], appointment_type, date, booking_map)
+                    build_options(validation_result['violatedSlot'], appointment_type, date, booking_map, clinic, locale,
+                                  request.session_id)
                 )
             )
 
         if not appointment_type:
             return elicit_slot(
                 session_attributes,
-                'MakeAppointment',
+                request.intent_name,
                 slots,
                 'AppointmentType',
-                {'contentType': 'PlainText', 'content': 'What type of appointment would you like to schedule?'},
-                build_response_card(
-                    'Specify Appointment Type',
-                    'What type of appointment would you like to schedule?',
-                    build_options('AppointmentType', appointment_type, date, None)
-                )
+                locale.messages['ask_appointment_type'],
+                locale.appointment_type_card
             )
 
         if appointment_type and not date:
             return elicit_slot(
                 session_attributes,
-                'MakeAppointment',
+                request.intent_name,
                 slots,
                 'Date',
-                {'contentType': 'PlainText', 'content': 'When would you like to schedule your {}?'.format(appointment_type)},
+                plain_text_message(locale.texts['ask_date'].format(locale.service_name(appointment_type))),
                 build_response_card(
-                    'Specify Date',
-                    'When would you like to schedule your {}?'.format(appointment_type),
-                    build_options('Date', appointment_type, date, None)
+                    locale.texts['card_Date'],
+                    locale.texts['ask_date'].format(locale.service_name(appointment_type)),
+                    build_options('Date', appointment_type, date, None, clinic, locale)
                 )
             )
 
         if appointment_type and date:
-            # Ensure we have a consistent date format for the booking map
-            try:
-                parsed_date = dateutil.parser.parse(date).strftime('%Y-%m-%d')
-                logger.debug(f"Parsed date for availability check: {parsed_date}")
-                
-                # Get or generate availabilities
-                booking_availabilities = booking_map.get(parsed_date)
-                if booking_availabilities is None:
-                    booking_availabilities = get_availabilities(date)  # Use original date string
-                    if booking_availabilities:  # Only store if we got availabilities
-                        booking_map[parsed_date] = booking_availabilities
-                        session_attributes['bookingMap'] = json.dumps(booking_map)
-                    
-                logger.debug(f"Retrieved availabilities for date {parsed_date}: {booking_availabilities}")
-                
-            except (ValueError, TypeError) as e:
-                logger.error(f"Error processing date {date}: {e}")
+            if appointment_date is None:
+                logger.error('Error processing date %s', date)
                 return elicit_slot(
                     session_attributes,
-                    'MakeAppointment',
+                    request.intent_name,
                     slots,
                     'Date',
-                    {'contentType': 'PlainText', 'content': 'I had trouble understanding that date. Please provide a date in YYYY-MM-DD format.'},
-                    build_options('Date', appointment_type, None, None)
+                    locale.messages['date_parse_error'],
+                    build_response_card(
+                        locale.texts['card_Date'],
+                        locale.texts['ask_date_short'],
+                        build_options('Date', appointment_type, None, None, clinic, locale)
+                    )
                 )
 
-            appointment_type_availabilities = get_availabilities_for_duration(get_duration(appointment_type), booking_availabilities)
+            # Get or generate availabilities. A shared backend is the source of truth, since other sessions
+            # may have booked since this session's bookingMap was filled in. It is read through the availability
+            # cache; a window another process took meanwhile is caught by the hold below.
+            shared_backend = get_availability_backend().shared
+            booking_availabilities = None if shared_backend else booking_map.get(date)
+            if booking_availabilities is None:
+                booking_availabilities = get_day_mask(appointment_date, clinic)
+                if booking_availabilities:  # Only store if we got availabilities
+                    booking_map[date] = booking_availabilities
+                    session_attributes['bookingMap'] = encode_booking_map(booking_map)
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Retrieved availabilities for date %s: %s', date, mask_to_availabilities(any_provider_mask(booking_availabilities)))
+            # Times other sessions are confirming are not offered, nor tried for this one
+            offered_availabilities = booking_availabilities
+            if shared_backend and booking_availabilities:
+                offered_availabilities = without_held(booking_availabilities, appointment_date, request.session_id, clinic)
+
+            appointment_type_availabilities = get_service_start_times(appointment_type, offered_availabilities)
+            if len(appointment_type_availabilities) == 1:
+                provider = hold_appointment(appointment_date, appointment_type, time_to_slot(appointment_type_availabilities[0]),
+                                            offered_availabilities, request.session_id, clinic)
+                if provider is None:
+                    # The only window left is being confirmed by another session
+                    appointment_type_availabilities = []
+                else:
+                    session_attributes['provider'] = provider.provider_id
             if len(appointment_type_availabilities) == 0:
                 slots['Date'] = None
                 slots['Time'] = None
+                message = locale.messages['date_full']
+                next_availabilities = find_next_availabilities(appointment_type, booking_map, 1, appointment_date, clinic)
+                if next_availabilities:
+                    next_day, next_starts = next_availabilities[0]
+                    message = plain_text_message(locale.texts['date_full_next_opening'].format(
+                        locale.format_time(mask_to_availabilities(next_starts)[0]), locale.format_date(next_day)))
                 return elicit_slot(
                     session_attributes,
-                    'MakeAppointment',
+                    request.intent_name,
                     slots,
                     'Date',
-                    {'contentType': 'PlainText', 'content': 'We do not have any availability on that date, is there another day which works for you?'},
+                    message,
                     build_response_card(
-                        'Specify Date',
-                        'What day works best for you?',
-                        build_options('Date', appointment_type, date, booking_map)
+                        locale.texts['card_Date'],
+                        locale.texts['ask_date_short'],
+                        build_options('Date', appointment_type, date, booking_map, clinic, locale)
                     )
                 )
 
-            message_content = 'What time on {} works for you? '.format(date)
+            message_content = locale.texts['ask_time'].format(locale.format_date(appointment_date))
             if appointment_time:
-                session_attributes['formattedTime'] = build_time_output_string(appointment_time)
-                if is_available(appointment_time, get_duration(appointment_type), booking_availabilities):
-                    return delegate(session_attributes, slots)
-                message_content = 'The time you requested is not available. '
+                session_attributes['formattedTime'] = locale.format_time(appointment_time)
+                # Hold a free provider while the customer confirms, so fulfillment does not lose the window to another session
+                start_slot = time_to_slot(appointment_time)
+                provider = start_slot is not None and hold_appointment(
+                    appointment_date, appointment_type, start_slot, offered_availabilities, request.session_id, clinic)
+                if provider:
+                    session_attributes['provider'] = provider.provider_id
+                    return delegate(session_attributes, request.intent_name, slots)
+                message_content = locale.texts['time_unavailable']
 
             if len(appointment_type_availabilities) == 1:
                 slots['Time'] = appointment_type_availabilities[0]
                 return confirm_intent(
                     session_attributes,
-                    'MakeAppointment',
+                    request.intent_name,
                     slots,
-                    {
-                        'contentType': 'PlainText',
-                        'content': '{}{} is our only availability, does that work for you?'.format(
-                            message_content, build_time_output_string(appointment_type_availabilities[0]))
-                    },
+                    plain_text_message(locale.texts['only_availability'].format(
+                        message_content, locale.format_time(appointment_type_availabilities[0]))),
                     build_response_card(
-                        'Confirm Appointment',
-                        'Is {} on {} okay?'.format(build_time_output_string(appointment_type_availabilities[0]), date),
-                        [{'text': 'yes', 'value': 'yes'}, {'text': 'no', 'value': 'no'}]
+                        locale.texts['card_confirm'],
+                        locale.texts['confirm_appointment'].format(locale.format_time(appointment_type_availabilities[0]), locale.format_date(appointment_date)),
+                        list(locale.confirm_options)
                     )
                 )
 
-            available_time_string = build_available_time_string(appointment_type_availabilities)
+            available_time_string = build_available_time_string(appointment_type_availabilities, locale)
             return elicit_slot(
                 session_attributes,
-                'MakeAppointment',
+                request.intent_name,
                 slots,
                 'Time',
-                {'contentType': 'PlainText', 'content': '{}{}'.format(message_content, available_time_string)},
+                plain_text_message(message_content + available_time_string),
                 build_response_card(
-                    'Specify Time',
-                    'What time works best for you?',
-                    build_options('Time', appointment_type, date, booking_map)
+                    locale.texts['card_Time'],
+                    locale.texts['ask_time_short'],
+                    build_options('Time', appointment_type, date, {date: offered_availabilities}, clinic, locale)
                 )
             )
 
-        return delegate(session_attributes, slots)
+        return delegate(session_attributes, request.intent_name, slots)
 
     # Only proceed with booking if this is a fulfillment request
     if source != 'FulfillmentCodeHook':
         logger.debug("Not a fulfillment request, returning delegate response")
-        return delegate(session_attributes, slots)
+        return delegate(session_attributes, request.intent_name, slots)
         
-    # Book the appointment
+    # Book the appointment. A failure other than losing the window asks the customer to try again or call.
     if not appointment_type or not date or not appointment_time:
         return close(
             session_attributes,
+            request.intent_name,
             'Failed',
-            {
-                'contentType': 'PlainText',
-                'content': 'Please provide all required information: appointment type, date, and time.'
-            }
+            locale.messages['booking_failed']
         )
         
     duration = get_duration(appointment_type)
@@ -537,103 +2177,570 @@ def make_appointment(intent_request):
         hour, minute = appointment_time.split(':')
         appointment_time = f"{int(hour):02d}:{int(minute):02d}"
         
-        parsed_date = dateutil.parser.parse(date).strftime('%Y-%m-%d')
-        booking_availabilities = booking_map.get(parsed_date, [])
-        logger.debug(f"Retrieved booking availabilities for date {parsed_date}: {booking_availabilities}")
+        if appointment_date is None:
+            raise ValueError('Could not parse date {}'.format(date))
+        if not duration:
+            raise ValueError('Unknown appointment type {}'.format(appointment_type))
+        booking_availabilities = booking_map.get(date, 0)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Retrieved booking availabilities for date %s: %s', date, mask_to_availabilities(any_provider_mask(booking_availabilities)))
     except (ValueError, TypeError) as e:
-        logger.error(f"Error processing date/time for booking: {e}")
+        logger.error('Error processing date/time for booking: %s', e)
         return close(
             session_attributes,
+            request.intent_name,
             'Failed',
-            {
-                'contentType': 'PlainText',
-                'content': 'I encountered an error while trying to book your appointment. Please try again with a valid date and time.'
-            }
+            locale.messages['booking_failed']
         )
 
-    if booking_availabilities:
-        booking_availabilities.remove(appointment_time)
-        if duration == 60:
-            second_half_hour_time = increment_time_by_thirty_mins(appointment_time)
-            booking_availabilities.remove(second_half_hour_time)
+    shared_backend = get_availability_backend().shared
+    start_slot = time_to_slot(appointment_time)
+    provider = None
+    if start_slot is not None:
+        # Without a shared backend the session's own bookingMap is the only record of what it already booked
+        provider = book_appointment(
+            appointment_date, appointment_type, start_slot, request.session_id, clinic, session_attributes.get('provider'),
+            None if shared_backend or not booking_availabilities else booking_availabilities, request.customer_id
+        )
+    if provider is None:
+        logger.debug('%s on %s could not be booked.', appointment_time, date)
+        return close(
+            session_attributes,
+            request.intent_name,
+            'Failed',
+            plain_text_message(locale.texts['slot_taken'].format(locale.format_time(appointment_time), locale.format_date(appointment_date)))
+        )
 
-        booking_map[date] = booking_availabilities
-        session_attributes['bookingMap'] = json.dumps(booking_map)
+    if shared_backend:
+        booking_map[date] = get_day_mask(appointment_date, clinic)
+        session_attributes['bookingMap'] = encode_booking_map(booking_map)
+    elif booking_availabilities:
+        booking_map[date] = book_provider_window(booking_availabilities, provider, start_slot, slots_for_duration(duration))
+        session_attributes['bookingMap'] = encode_booking_map(booking_map)
     else:
-        logger.debug('Availabilities for {} were null at fulfillment time.'.format(date))
+        logger.debug('Availabilities for %s were null at fulfillment time.', date)
+    session_attributes['provider'] = provider.provider_id
+    session_attributes['appointment'] = Booking(
+        appointment_type, appointment_date, provider, start_slot, slots_for_duration(duration)).encode()
 
     # Only return Fulfilled for FulfillmentCodeHook
     if source == 'FulfillmentCodeHook':
         return close(
             session_attributes,
+            request.intent_name,
             'Fulfilled',
-            {
-                'contentType': 'PlainText',
-                'content': 'Okay, I have booked your {} appointment. We will see you at {} on {}'.format(
-                    appointment_type.lower(), build_time_output_string(appointment_time), date)
-            }
+            plain_text_message(locale.texts['booked'].format(
+                locale.service_name(appointment_type), locale.format_time(appointment_time),
+                locale.format_date(appointment_date)))
         )
     else:
         # For any other source, return InProgress
         return close(
             session_attributes,
+            request.intent_name,
             'InProgress',
-            {
-                'contentType': 'PlainText',
-                'content': 'Processing your appointment request for {} at {} on {}.'.format(
-                    appointment_type.lower(), build_time_output_string(appointment_time), date)
-            }
+            plain_text_message(locale.texts['processing'].format(
+                locale.service_name(appointment_type), locale.format_time(appointment_time),
+                locale.format_date(appointment_date)))
+        )
+
+def describe_booking(booking, locale):
+    return locale.service_name(booking.appointment_type), locale.format_time(booking.time), locale.format_date(booking.day)
+
+@timed_phase('CancelAppointment')
+def cancel_appointment(request):
+    """
+    Performs dialog management and fulfillment for cancelling the customer's next appointment.
+    """
+    session_attributes = request.session_attributes
+    locale = request.locale
+    intent_name = request.intent_name
+    source = request.invocation_source
+
+    booking = find_booking(request)
+    if booking is None:
+        return close(session_attributes, intent_name, 'Failed', locale.messages['no_booking'])
+
+    if source == 'DialogCodeHook':
+        if request.confirmation_state == 'Denied':
+            return close(session_attributes, intent_name, 'Failed', locale.messages['keep_appointment'])
+        if request.confirmation_state != 'Confirmed':
+            message_content = locale.texts['confirm_cancel'].format(*describe_booking(booking, locale))
+            return confirm_intent(
+                session_attributes,
+                intent_name,
+                request.slots,
+                plain_text_message(message_content),
+                build_response_card(locale.texts['card_cancel'], message_content, list(locale.confirm_options))
+            )
+        return delegate(session_attributes, intent_name, request.slots)
+
+    if source != 'FulfillmentCodeHook':
+        return delegate(session_attributes, intent_name, request.slots)
+
+    if not cancel_booking(booking, request.customer_id, request.clinic):
+        return close(session_attributes, intent_name, 'Failed', locale.messages['cancel_failed'])
+
+    session_attributes.pop('appointment', None)
+    if not get_availability_backend().shared:
+        release_session_booking(session_attributes, decode_booking_map(session_attributes.get('bookingMap')), booking)
+    return close(
+        session_attributes,
+        intent_name,
+        'Fulfilled',
+        plain_text_message(locale.texts['cancelled'].format(*describe_booking(booking, locale)))
+    )
+
+@timed_phase('RescheduleAppointment')
+def reschedule_appointment(request):
+    """
+    Performs dialog management and fulfillment for moving the customer's next appointment to the Date and Time
+    slots. The move is a single backend operation, so the old window is only freed once the new one is taken.
+    """
+    session_attributes = request.session_attributes
+    slots = request.slots
+    clinic = request.clinic
+    locale = request.locale
+    intent_name = request.intent_name
+    source = request.invocation_source
+
+    booking = find_booking(request)
+    if booking is None:
+        return close(session_attributes, intent_name, 'Failed', locale.messages['no_booking'])
+    if source == 'DialogCodeHook' and request.confirmation_state == 'Denied':
+        return close(session_attributes, intent_name, 'Failed', locale.messages['keep_appointment'])
+
+    appointment_type = booking.appointment_type
+    appointment_date = request.appointment_date
+    date = appointment_date.isoformat() if appointment_date is not None else request.date
+    appointment_time = request.appointment_time
+    booking_map = decode_booking_map(session_attributes.get('bookingMap'))
+    shared_backend = get_availability_backend().shared
+
+    validation_result = validate_appointment(
+        appointment_type, request.date, appointment_date, appointment_time, request.today, locale)
+    starts = 0
+    if validation_result['isValid'] and appointment_date is not None:
+        mask = None if shared_backend else booking_map.get(date)
+        if mask is None:
+            mask = get_day_mask(appointment_date, clinic)
+        if shared_backend:
+            mask = without_held(mask, appointment_date, request.session_id, clinic)
+        if appointment_date == booking.day:
+            # The customer's own window is free for the move
+            mask |= booking.window << booking.provider.shift
+        starts = service_fit_mask(appointment_type, mask)
+
+    if source == 'DialogCodeHook':
+        if not validation_result['isValid']:
+            slots[validation_result['violatedSlot']] = None
+            return elicit_slot(
+                session_attributes,
+                intent_name,
+                slots,
+                validation_result['violatedSlot'],
+                validation_result['message'],
+                build_response_card(
+                    locale.texts['card_' + validation_result['violatedSlot']],
+                    validation_result['message']['content'],
+                    build_options(validation_result['violatedSlot'], appointment_type, date, booking_map, clinic, locale,
+                                  request.session_id)
+                )
+            )
+
+        if not date or not starts:
+            slots['Date'] = None
+            slots['Time'] = None
+            message_content = locale.texts['date_full'] if date else locale.texts['ask_reschedule_date'].format(
+                *describe_booking(booking, locale))
+            return elicit_slot(
+                session_attributes,
+                intent_name,
+                slots,
+                'Date',
+                plain_text_message(message_content),
+                build_response_card(
+                    locale.texts['card_Date'],
+                    locale.texts['ask_date_short'],
+                    build_options('Date', appointment_type, None, booking_map, clinic, locale)
+                )
+            )
+
+        available_times = mask_to_availabilities(starts)
+        message_content = ''
+        if appointment_time and not starts >> time_to_slot(appointment_time) & 1:
+            message_content = locale.texts['time_unavailable']
+            appointment_time = None
+        if not appointment_time and len(available_times) == 1:
+            # As in make_appointment, the only start that fits is offered for confirmation
+            appointment_time = slots['Time'] = available_times[0]
+        if not appointment_time:
+            message_content = message_content or locale.texts['ask_time'].format(locale.format_date(appointment_date))
+            slots['Time'] = None
+            return elicit_slot(
+                session_attributes,
+                intent_name,
+                slots,
+                'Time',
+                plain_text_message(message_content + build_available_time_string(available_times, locale)),
+                build_response_card(locale.texts['card_Time'], locale.texts['ask_time_short'], build_time_options(starts, locale))
+            )
+
+        if request.confirmation_state != 'Confirmed':
+            # Hold the new window while the customer confirms, as make_appointment does. A window overlapping the
+            # customer's own booking is not free to hold yet; the move itself still checks it.
+            start_slot = time_to_slot(appointment_time)
+            overlaps_booking = appointment_date == booking.day and booking.window & window_mask(start_slot, booking.slot_count)
+            if not overlaps_booking and hold_appointment(
+                    appointment_date, appointment_type, start_slot, mask, request.session_id, clinic) is None:
+                # Another session is confirming this window
+                slots['Time'] = None
+                return elicit_slot(
+                    session_attributes,
+                    intent_name,
+                    slots,
+                    'Time',
+                    plain_text_message(locale.texts['time_unavailable'] + locale.texts['ask_time_short']),
+                    build_response_card(
+                        locale.texts['card_Time'], locale.texts['ask_time_short'],
+                        build_time_options(starts & ~(1 << start_slot), locale)
+                    )
+                )
+            confirmation = locale.texts['confirm_reschedule'].format(
+                *describe_booking(booking, locale), locale.format_time(appointment_time), locale.format_date(appointment_date))
+            if message_content:
+                # The requested time was taken and this is the only one left
+                message_content = locale.texts['only_availability'].format(message_content, locale.format_time(appointment_time))
+            return confirm_intent(
+                session_attributes,
+                intent_name,
+                slots,
+                plain_text_message(message_content or confirmation),
+                build_response_card(locale.texts['card_confirm'], confirmation, list(locale.confirm_options))
+            )
+        return delegate(session_attributes, intent_name, slots)
+
+    if source != 'FulfillmentCodeHook':
+        return delegate(session_attributes, intent_name, slots)
+
+    start_slot = time_to_slot(appointment_time) if appointment_time else None
+    if start_slot is None or appointment_date is None or not validation_result['isValid']:
+        return close(session_attributes, intent_name, 'Failed', locale.messages['missing_information'])
+
+    provider = move_booking(booking, appointment_date, start_slot, request.customer_id, request.session_id, clinic,
+                            None if shared_backend else mask)
+    if provider is None:
+        return close(
+            session_attributes,
+            intent_name,
+            'Failed',
+            plain_text_message(locale.texts['slot_taken'].format(locale.format_time(appointment_time), locale.format_date(appointment_date)))
+        )
+
+    moved = Booking(appointment_type, appointment_date, provider, start_slot, booking.slot_count)
+    if not shared_backend:
+        release_session_booking(session_attributes, booking_map, booking)
+        booking_map[date] = book_provider_window(
+            booking_map.get(date, mask), provider, start_slot, booking.slot_count)
+        session_attributes['bookingMap'] = encode_booking_map(booking_map)
+    session_attributes['provider'] = provider.provider_id
+    session_attributes['appointment'] = moved.encode()
+    return close(
+        session_attributes,
+        intent_name,
+        'Fulfilled',
+        plain_text_message(locale.texts['rescheduled'].format(*describe_booking(moved, locale)))
+    )
+
+INTENT_HANDLERS = {
+    'MakeAppointment': make_appointment,
+    'CancelAppointment': cancel_appointment,
+    'RescheduleAppointment': reschedule_appointment,
+}
+
+""" --- Admission control: a token bucket per Lex session, so a looping client cannot crowd out the others --- """
+
+# A session may send up to RATE_LIMIT_BURST dialog turns at once, refilled at RATE_LIMIT_PER_MINUTE; 0 turns it off.
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 0))
+RATE_LIMIT_PER_MINUTE = float(os.environ.get('RATE_LIMIT_PER_MINUTE', 30))
+RATE_LIMIT_SESSIONS = int(os.environ.get('RATE_LIMIT_SESSIONS', 10000))
+
+class SessionRateLimiter:
+    """
+    Token buckets keyed by session ID in a bounded LRU: each admitted turn takes a token, and a bucket refills at
+    rate_per_second up to burst. A session evicted from the LRU starts over with a full bucket, so max_sessions
+    should cover the sessions a container sees within burst / rate_per_second seconds.
+    """
+
+    def __init__(self, burst, rate_per_second, max_sessions):
+        self.burst = burst
+        self.rate_per_second = rate_per_second
+        self.max_sessions = max_sessions
+        # session ID -> [tokens, monotonic time they were counted at]
+        self.buckets = collections.OrderedDict()
+        self.admitted = 0
+        self.rejected = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {'size': len(self.buckets), 'admitted': self.admitted, 'rejected': self.rejected, 'evictions': self.evictions}
+
+    def admit(self, session_id, now=None):
+        """
+        Take a token from the session's bucket; False when it has none left.
+        """
+        if now is None:
+            now = time.monotonic()
+        bucket = self.buckets.get(session_id)
+        if bucket is None:
+            bucket = self.buckets[session_id] = [self.burst, now]
+            while len(self.buckets) > self.max_sessions:
+                self.buckets.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.buckets.move_to_end(session_id)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate_per_second)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            self.rejected += 1
+            count_metric('RateLimitedTurns')
+            return False
+        bucket[0] -= 1
+        self.admitted += 1
+        count_metric('AdmittedTurns')
+        return True
+
+rate_limiter = None
+if RATE_LIMIT_BURST > 0:
+    rate_limiter = SessionRateLimiter(RATE_LIMIT_BURST, RATE_LIMIT_PER_MINUTE / 60, RATE_LIMIT_SESSIONS)
+
+def admit_turn(request):
+    """
+    Whether a turn may run its intent handler. Only dialog turns are limited: fulfillment completes a booking
+    the customer already confirmed.
+    """
+    if rate_limiter is None or request.invocation_source != 'DialogCodeHook' or request.session_id is None:
+        return True
+    return rate_limiter.admit(request.session_id)
+
+def rate_limited(request):
+    """
+    Answer a turn over its session's limit without validating or reading availability: the session state is
+    handed back as it came, with the locale's prebuilt message, and Lex asks for the same slot again.
+    """
+    message = request.locale.messages['rate_limited']
+    slots = request.slots or {}
+    slot_to_elicit = (
+        ((request.event.get('proposedNextState') or {}).get('dialogAction') or {}).get('slotToElicit')
+        or next((name for name, value in slots.items() if value is None), None)
+        or next(iter(slots), None)
+    )
+    if slot_to_elicit is None:
+        return close(request.session_attributes, request.intent_name, 'Failed', message)
+    return elicit_slot(request.session_attributes, request.intent_name, request.slots, slot_to_elicit, message, None)
+
+""" --- Idempotent fulfillment: the response to a fulfillment is kept so Lex retries replay it --- """
+
+# How many fulfillment responses are kept, and for how long; 0 for either turns deduplication off.
+FULFILLMENT_CACHE_SIZE = int(os.environ.get('FULFILLMENT_CACHE_SIZE', 1024))
+FULFILLMENT_CACHE_TTL_SECONDS = float(os.environ.get('FULFILLMENT_CACHE_TTL_SECONDS', 300))
+
+def fulfillment_key(request):
+    """
+    Identify a fulfillment by session, intent, slot values and session attributes, encoded as compact JSON. A
+    Lex retry repeats all of them, in the same order, while a later fulfillment in the same session comes with
+    the attributes the previous one returned.
+    """
+    slots = request.slots or {}
+    identity = [
+        request.session_id, request.intent_name,
+        [(name, get_slot_value(slots, name)) for name in slots], request.session_attributes
+    ]
+    return RESPONSE_ENCODER.encode(identity)
+
+class FulfillmentCache:
+    """
+    Serialized fulfillment responses by key in a bounded LRU within the container, each kept for ttl_seconds.
+    A replay decodes the stored response, so it never shares dicts with the one returned the first time.
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # key -> (expires_at, serialized response)
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def load(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def save(self, key, serialized):
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, serialized)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key):
+        """
+        Return the response stored for key, or None.
+        """
+        serialized = self.load(key)
+        if serialized is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(serialized)
+
+    def put(self, key, response):
+        self.save(key, serialize_response(response))
+
+class SQLiteFulfillmentCache(FulfillmentCache):
+    """
+    Fulfillment responses in the SQLite database that holds the bookings, so a retry served by another process
+    using that database on the same host is replayed as well. Expired rows are deleted as new ones are written,
+    and the oldest rows beyond max_entries with them.
+    """
+
+    def __init__(self, path, max_entries, ttl_seconds):
+        super().__init__(max_entries, ttl_seconds)
+        self.connection = open_database(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS fulfillment_response ('
+            'request_key TEXT PRIMARY KEY, expires_at REAL NOT NULL, response TEXT NOT NULL) WITHOUT ROWID'
         )
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS fulfillment_response_expiry ON fulfillment_response (expires_at)'
+        )
+
+    def stats(self):
+        size = self.connection.execute('SELECT COUNT(*) FROM fulfillment_response').fetchone()[0]
+        return dict(super().stats(), size=size)
+
+    def load(self, key):
+        row = self.connection.execute(
+            'SELECT response FROM fulfillment_response WHERE request_key = ? AND expires_at > ?', (key, time.time())
+        ).fetchone()
+        return row and row[0]
+
+    def save(self, key, serialized):
+        now = time.time()
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.execute('DELETE FROM fulfillment_response WHERE expires_at <= ?', (now,))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO fulfillment_response (request_key, expires_at, response) VALUES (?, ?, ?)',
+                (key, now + self.ttl_seconds, serialized)
+            )
+            evicted = self.connection.execute(
+                'DELETE FROM fulfillment_response WHERE request_key IN ('
+                'SELECT request_key FROM fulfillment_response ORDER BY expires_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            ).rowcount
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+        self.evictions += evicted
+
+fulfillment_cache = None
+
+def get_fulfillment_cache():
+    """
+    Return the container's fulfillment cache, creating it on first use: in the database of AVAILABILITY_DB_PATH
+    when it is set, since a booking made there must not be repeated by a retry another process on the host
+    serves, and in memory otherwise. None when FULFILLMENT_CACHE_SIZE or FULFILLMENT_CACHE_TTL_SECONDS is 0.
+
+    Only finished fulfillments are stored: a retry arriving while the first attempt still runs goes through the
+    handler again.
+    """
+    global fulfillment_cache
+    if fulfillment_cache is None and FULFILLMENT_CACHE_SIZE > 0 and FULFILLMENT_CACHE_TTL_SECONDS > 0:
+        db_path = os.environ.get('AVAILABILITY_DB_PATH')
+        if db_path:
+            fulfillment_cache = SQLiteFulfillmentCache(db_path, FULFILLMENT_CACHE_SIZE, FULFILLMENT_CACHE_TTL_SECONDS)
+        else:
+            fulfillment_cache = FulfillmentCache(FULFILLMENT_CACHE_SIZE, FULFILLMENT_CACHE_TTL_SECONDS)
+    return fulfillment_cache
 
 def lambda_handler(event, context):
     """
     Route the incoming request based on intent.
     The JSON body of the request is provided in the event slot.
     """
-    import time
-    os.environ['TZ'] = 'America/New_York'
-    time.tzset()
-    
-    logger.debug('event={}'.format(json.dumps(event)))
+    set_request_id(context)
+    try:
+        return route_request(event)
+    finally:
+        # Records logged between invocations belong to none of them
+        set_request_id(None)
+
+def route_request(event):
+    # Full event dumps are large; only a sampled fraction of invocations log one.
+    if EVENT_LOG_SAMPLE_RATE and random.random() < EVENT_LOG_SAMPLE_RATE:
+        logger.info('event=%s', json.dumps(event))
+
+    request = IntentRequest(event)
+    locale = request.locale
 
     # Check if this is a dialog code hook or fulfillment
-    source = event.get('invocationSource')
-    logger.debug(f"Invocation source: {source}")
+    source = request.invocation_source
+    logger.debug('Invocation source: %s', source)
     
-    response = make_appointment(event)
+    # A retried fulfillment is answered as the first attempt was, without booking again
+    cache = get_fulfillment_cache() if source == 'FulfillmentCodeHook' else None
+    key = None
+    if cache is not None:
+        key = fulfillment_key(request)
+        replayed = cache.get(key)
+        if replayed is not None:
+            logger.debug('Replaying the fulfillment response of session %s', request.session_id)
+            count_metric('FulfillmentReplays')
+            flush_metrics(request.intent_name, source)
+            return replayed
+
+    handler = INTENT_HANDLERS.get(request.intent_name, make_appointment)
+    if not admit_turn(request):
+        logger.debug('Session %s is over its rate limit', request.session_id)
+        handler = rate_limited
+    try:
+        response = handler(request)
+    finally:
+        flush_metrics(request.intent_name, source)
     
     # Debug the response type
-    logger.debug(f"Response type: {response.get('sessionState', {}).get('dialogAction', {}).get('type')}")
-    logger.debug(f"Intent state: {response.get('sessionState', {}).get('intent', {}).get('state')}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Response type: %s', response.get('sessionState', {}).get('dialogAction', {}).get('type'))
+        logger.debug('Intent state: %s', response.get('sessionState', {}).get('intent', {}).get('state'))
     
-    # If the intent is fulfilled or failed, ensure we return a detailed message
+    # If the intent is ready for fulfillment, ensure we return a detailed message
     if ('sessionState' in response and 
         'intent' in response['sessionState']):
         
         intent_state = response['sessionState']['intent'].get('state')
         
-        if intent_state == 'Failed':
-            response['sessionState']['messages'] = [{
-                'contentType': 'PlainText',
-                'content': 'I apologize, but I was unable to book your appointment. Please try again with a different time or date, or contact our office directly at (555) 123-4567 for assistance.'
-            }]
-        elif intent_state == 'ReadyForFulfillment':
+        if intent_state == 'ReadyForFulfillment':
             # Only add the confirmation message if this is a fulfillment request
-            if event.get('invocationSource') == 'FulfillmentCodeHook':
-                
-                # Get the appointment details from the slots
-                slots = event['sessionState']['intent']['slots']
-                appointment_type = slots['AppointmentType']['value']['interpretedValue']
-                date = slots['Date']['value']['interpretedValue']
-                time = slots['Time']['value']['interpretedValue']
+            if source == 'FulfillmentCodeHook':
                 
                 # Format the time nicely
-                formatted_time = build_time_output_string(time)
+                formatted_time = locale.format_time(request.appointment_time)
                 
                 # Return a more detailed confirmation message
-                response['sessionState']['messages'] = [{
-                    'contentType': 'PlainText',
-                    'content': f'Perfect! Your {appointment_type} appointment has been confirmed for {formatted_time} on {date}. We look forward to seeing you! Please arrive 10 minutes before your appointment time.'
-                }]
-    
+                response['sessionState']['messages'] = [plain_text_message(locale.texts['confirmed'].format(
+                    locale.service_name(request.appointment_type), formatted_time,
+                    request.date if request.appointment_date is None else locale.format_date(request.appointment_date)))]
+
+    if key is not None:
+        cache.put(key, response)
     return response
\ No newline at end of file
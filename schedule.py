@@ -0,0 +1,214 @@
+"""
+Schedule export and appointment reminders over the bookings of lambda_function.py.
+
+Usage:
+    python schedule.py export [--day YYYY-MM-DD | --week YYYY-MM-DD | --from YYYY-MM-DD --to YYYY-MM-DD]
+                              [--format ndjson|csv] [--clinic ID] [--output FILE]
+    python schedule.py remind [--day YYYY-MM-DD] [--batch-size 100] [--clinic ID] [--locale ID] [--sink FILE]
+
+Both read the booking index of the shared backend, so AVAILABILITY_DB_PATH must point at the same SQLite
+database as the code hook. Bookings are streamed from the database one row at a time and written out as they
+arrive, so memory use does not grow with the number of bookings.
+
+export writes one record per booking, as NDJSON or CSV, for a day, the Monday-to-Sunday week containing a
+date, or a range of days (default: the clinic's tomorrow).
+
+remind sends a reminder for every booking on a day (default: the clinic's tomorrow), grouped into batches of
+--batch-size notifications, in the --locale of the message catalog (default: DEFAULT_LOCALE). Batches go to a
+local stand-in for a notification service that appends each notification to --sink as a JSON line (default:
+standard output).
+"""
+import argparse
+import csv
+import datetime
+import itertools
+import logging
+import sys
+
+import lambda_function
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FIELDS = ('clinicId', 'date', 'time', 'endTime', 'provider', 'appointmentType', 'customerId')
+
+
+def schedule_records(bookings, clinic_id):
+    """
+    Turn (customer_id, Booking) pairs into export records, one at a time.
+    """
+    for customer_id, booking in bookings:
+        yield {
+            'clinicId': clinic_id,
+            'date': booking.day.isoformat(),
+            'time': booking.time,
+            'endTime': lambda_function.SLOT_TIMES[booking.start_slot + booking.slot_count],
+            'provider': booking.provider.provider_id,
+            'appointmentType': booking.appointment_type,
+            'customerId': customer_id,
+        }
+
+
+def write_ndjson(records, output):
+    count = 0
+    for record in records:
+        output.write(lambda_function.RESPONSE_ENCODER.encode(record))
+        output.write('\n')
+        count += 1
+    return count
+
+
+def write_csv(records, output):
+    writer = csv.DictWriter(output, EXPORT_FIELDS, lineterminator='\n')
+    writer.writeheader()
+    count = 0
+    for record in records:
+        writer.writerow(record)
+        count += 1
+    return count
+
+
+WRITERS = {'ndjson': write_ndjson, 'csv': write_csv}
+
+
+def batched(iterable, size):
+    """
+    Yield lists of up to size consecutive items of iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class FileNotificationSink:
+    """
+    Stand-in for a notification service with a batch send API: each notification of a batch is appended to
+    output as a JSON line tagged with its batch number.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.batches = 0
+        self.sent = 0
+
+    def send_batch(self, notifications):
+        self.batches += 1
+        for notification in notifications:
+            self.output.write(lambda_function.RESPONSE_ENCODER.encode(dict(notification, batch=self.batches)))
+            self.output.write('\n')
+        self.output.flush()
+        self.sent += len(notifications)
+
+
+def reminder_notifications(records, locale):
+    """
+    Build the reminder for each export record, in the given lambda_function.Locale.
+    """
+    reminder = locale.texts['reminder']
+    for record in records:
+        yield {
+            'customerId': record['customerId'],
+            'clinicId': record['clinicId'],
+            'message': reminder.format(
+                locale.service_name(record['appointmentType']), locale.format_time(record['time']),
+                locale.format_date(datetime.date.fromisoformat(record['date']))),
+        }
+
+
+def send_reminders(records, sink, batch_size, locale=lambda_function.DEFAULT_LOCALE):
+    for batch in batched(reminder_notifications(records, locale), batch_size):
+        sink.send_batch(batch)
+    return sink.sent
+
+
+def parse_day(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not a YYYY-MM-DD date'.format(value))
+
+
+def export_range(args, clinic):
+    """
+    Return the (first, last) days the export arguments ask for.
+    """
+    if args.week:
+        monday = args.week - datetime.timedelta(days=args.week.weekday())
+        return monday, monday + datetime.timedelta(days=6)
+    if args.first_day or args.last_day:
+        if not (args.first_day and args.last_day):
+            sys.exit('--from and --to go together')
+        return args.first_day, args.last_day
+    day = args.day or clinic.today() + datetime.timedelta(days=1)
+    return day, day
+
+
+def get_shared_backend():
+    backend = lambda_function.get_availability_backend()
+    if not backend.shared:
+        sys.exit('Set AVAILABILITY_DB_PATH to the database of the code hook; without it no bookings are kept')
+    return backend
+
+
+def run_export(args):
+    clinic = lambda_function.get_clinic(args.clinic)
+    first_day, last_day = export_range(args, clinic)
+    bookings = get_shared_backend().iter_bookings(first_day, last_day, clinic.clinic_id)
+    output = sys.stdout if args.output in (None, '-') else open(args.output, 'w', newline='')
+    try:
+        count = WRITERS[args.format](schedule_records(bookings, clinic.clinic_id), output)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    logger.info('Exported %d bookings from %s to %s', count, first_day, last_day)
+
+
+def run_remind(args):
+    clinic = lambda_function.get_clinic(args.clinic)
+    day = args.day or clinic.today() + datetime.timedelta(days=1)
+    bookings = get_shared_backend().iter_bookings(day, day, clinic.clinic_id)
+    output = sys.stdout if args.sink in (None, '-') else open(args.sink, 'a')
+    sink = FileNotificationSink(output)
+    try:
+        send_reminders(schedule_records(bookings, clinic.clinic_id), sink, args.batch_size,
+                       lambda_function.get_locale(args.locale))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    logger.info('Sent %d reminders for %s in %d batches', sink.sent, day, sink.batches)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export = subparsers.add_parser('export', help='stream booked appointments as NDJSON or CSV')
+    days = export.add_mutually_exclusive_group()
+    days.add_argument('--day', type=parse_day, help='one day (default: tomorrow at the clinic)')
+    days.add_argument('--week', type=parse_day, help='the Monday-to-Sunday week containing this day')
+    days.add_argument('--from', dest='first_day', type=parse_day, help='first day of a range, with --to')
+    export.add_argument('--to', dest='last_day', type=parse_day, help='last day of a range, with --from')
+    export.add_argument('--format', choices=sorted(WRITERS), default='ndjson')
+    export.add_argument('--clinic', help='clinic ID (default: DEFAULT_CLINIC_ID)')
+    export.add_argument('--output', help='file to write (default: standard output)')
+    export.set_defaults(func=run_export)
+
+    remind = subparsers.add_parser('remind', help='send reminders for the appointments of a day')
+    remind.add_argument('--day', type=parse_day, help='day of the appointments (default: tomorrow at the clinic)')
+    remind.add_argument('--batch-size', type=int, default=100, help='notifications per batch')
+    remind.add_argument('--clinic', help='clinic ID (default: DEFAULT_CLINIC_ID)')
+    remind.add_argument('--locale', help='locale of the reminders, such as pt_BR (default: DEFAULT_LOCALE)')
+    remind.add_argument('--sink', help='file the stand-in notification service appends to (default: standard output)')
+    remind.set_defaults(func=run_remind)
+
+    args = parser.parse_args(argv)
+    lambda_function.configure_local_logging()
+    if args.command == 'remind' and args.batch_size < 1:
+        parser.error('--batch-size must be at least 1')
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
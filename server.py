@@ -0,0 +1,329 @@
+"""
+Local HTTP server for the MakeAppointment code hook in lambda_function.py.
+
+Usage:
+    python server.py serve [--host 0.0.0.0] [--port 8080] [--workers 4]
+    python server.py loadtest [--workers 2] [--concurrency 64] [--count 20000] [--target HOST:PORT] [--verify]
+
+serve accepts Lex V2 code hook events as the JSON body of a POST on any path and answers with the
+same bytes lambda_function.serialize_response(lambda_function.lambda_handler(event, context)) would,
+so the bot can be served behind a load balancer without Lambda cold starts. GET /health answers 200.
+Each worker is an asyncio process holding many keep-alive connections; with --workers > 1 the
+workers share the port through SO_REUSEPORT and the kernel spreads connections across them.
+
+When AVAILABILITY_DB_PATH points at a shared SQLite backend, invocations run on a dedicated thread
+so the event loop keeps reading and answering other connections while SQLite waits on disk. The
+default in-memory backend never blocks, so its invocations run inline on the loop.
+
+loadtest starts a local server (or targets --target), sends the generated scenarios of benchmark.py
+over --concurrency keep-alive connections and reports requests per second and p50/p99 latency.
+--verify also checks every response against an in-process lambda_handler call.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import statistics
+import sys
+import time
+import uuid
+
+import lambda_function
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_BYTES = 1024 * 1024
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error'}
+
+
+class RequestContext:
+    """
+    The part of the Lambda context object lambda_handler reads.
+    """
+    __slots__ = ('aws_request_id',)
+
+    def __init__(self, aws_request_id):
+        self.aws_request_id = aws_request_id
+
+
+def event_problem(event):
+    """
+    Return why a decoded body is not a Lex V2 code hook event lambda_handler can read, or None if it is.
+    """
+    if not isinstance(event, dict):
+        return 'the body is not a JSON object'
+    session_state = event.get('sessionState')
+    if not isinstance(session_state, dict) or not isinstance(session_state.get('intent'), dict):
+        return 'sessionState.intent is missing'
+    if not isinstance(session_state.get('sessionAttributes') or {}, dict):
+        return 'sessionState.sessionAttributes is not an object'
+    slots = session_state['intent'].get('slots') or {}
+    if not isinstance(slots, dict):
+        return 'sessionState.intent.slots is not an object'
+    for name, slot in slots.items():
+        if slot is not None and not (isinstance(slot, dict) and isinstance(slot.get('value'), dict)
+                                     and 'interpretedValue' in slot['value']):
+            return 'slot {} has no value.interpretedValue'.format(name)
+    return None
+
+
+def invoke(event, request_id):
+    """
+    Run one Lex event through lambda_handler and return the serialized response.
+    """
+    return lambda_function.serialize_response(lambda_function.lambda_handler(event, RequestContext(request_id))).encode()
+
+
+def http_response(status, body=b'', content_type='application/json', keep_alive=True):
+    return b'HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n%s' % (
+        status, REASONS[status].encode(), content_type.encode(), len(body), b'keep-alive' if keep_alive else b'close', body)
+
+
+class CodeHookServer:
+    """
+    One worker's HTTP/1.1 front end for lambda_handler.
+    """
+
+    def __init__(self):
+        # lambda_handler keeps per-invocation state (request ID, phase timings) in module globals, so
+        # invocations are never run concurrently within a process: the blocking ones share one thread.
+        self.executor = None
+        if lambda_function.get_availability_backend().shared:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='code-hook')
+
+    async def dispatch(self, event, request_id):
+        if self.executor is None:
+            return invoke(event, request_id)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, invoke, event, request_id)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+
+                request_line, _, header_block = head.decode('latin-1').partition('\r\n')
+                parts = request_line.split()
+                if len(parts) != 3:
+                    writer.write(http_response(400, keep_alive=False))
+                    break
+                method, path, version = parts
+                headers = {}
+                for line in header_block.split('\r\n'):
+                    name, _, value = line.partition(':')
+                    if name:
+                        headers[name.strip().lower()] = value.strip()
+
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    writer.write(http_response(400, keep_alive=False))
+                    break
+                if length > MAX_BODY_BYTES:
+                    writer.write(http_response(413, keep_alive=False))
+                    break
+                try:
+                    body = await reader.readexactly(length)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+
+                writer.write(await self.respond(method, path, headers, body, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, path, headers, body, keep_alive):
+        if method == 'GET':
+            if path == '/health':
+                return http_response(200, b'ok', 'text/plain', keep_alive)
+            return http_response(404, keep_alive=keep_alive)
+        if method != 'POST':
+            return http_response(405, keep_alive=keep_alive)
+
+        request_id = headers.get('x-request-id') or str(uuid.uuid4())
+        # A malformed event is the caller's fault; anything raised while handling a well-formed one is ours.
+        try:
+            event = json.loads(body)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            logger.warning('Rejected request %s: %s', request_id, e, extra={'aws_request_id': request_id})
+            return http_response(400, keep_alive=keep_alive)
+        problem = event_problem(event)
+        if problem is not None:
+            logger.warning('Rejected request %s: %s', request_id, problem, extra={'aws_request_id': request_id})
+            return http_response(400, keep_alive=keep_alive)
+        try:
+            payload = await self.dispatch(event, request_id)
+        except Exception:
+            logger.exception('Error handling request %s', request_id, extra={'aws_request_id': request_id})
+            return http_response(500, keep_alive=keep_alive)
+        return http_response(200, payload, keep_alive=keep_alive)
+
+
+async def serve_forever(host, port, reuse_port, ready=None):
+    server = CodeHookServer()
+    listener = await asyncio.start_server(server.handle_connection, host, port, reuse_port=reuse_port, backlog=1024)
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.cancel)
+    if ready is not None:
+        ready.set()
+    async with listener:
+        try:
+            await stop
+        except asyncio.CancelledError:
+            pass
+
+
+def run_worker(host, port, reuse_port, ready=None):
+    asyncio.run(serve_forever(host, port, reuse_port, ready))
+
+
+def start_workers(host, port, workers):
+    """
+    Start the worker processes and return them once all of them are listening.
+    """
+    if workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        logger.warning('SO_REUSEPORT is not available on this platform; starting a single worker')
+        workers = 1
+
+    processes = []
+    for _ in range(workers):
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target=run_worker, args=(host, port, workers > 1, ready), daemon=True)
+        process.start()
+        if not ready.wait(10):
+            raise RuntimeError('worker did not start listening on {}:{}'.format(host, port))
+        processes.append(process)
+    return processes
+
+
+def stop_workers(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+def run_serve(args):
+    if args.workers == 1:
+        run_worker(args.host, args.port, False)
+        return
+
+    processes = start_workers(args.host, args.port, args.workers)
+    print('serving on {}:{} with {} workers'.format(args.host, args.port, len(processes)))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_workers(processes)
+
+
+async def load_client(host, port, requests, latencies, mismatches, expected):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for name, body in requests:
+            started = time.perf_counter()
+            writer.write(b'POST / HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s' % (
+                host.encode(), len(body), body))
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = int(head.lower().split(b'content-length:')[1].split(b'\r\n')[0])
+            payload = await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+            if not head.startswith(b'HTTP/1.1 200'):
+                mismatches.append((name, head.split(b'\r\n')[0].decode()))
+            elif expected is not None and payload != expected[name]:
+                mismatches.append((name, 'response differs from lambda_handler'))
+    finally:
+        writer.close()
+
+
+async def load_test(host, port, corpus, concurrency, expected):
+    latencies = []
+    mismatches = []
+    shares = [corpus[index::concurrency] for index in range(concurrency)]
+    started = time.perf_counter()
+    await asyncio.gather(*(load_client(host, port, share, latencies, mismatches, expected) for share in shares if share))
+    return time.perf_counter() - started, latencies, mismatches
+
+
+def run_loadtest(args):
+    import benchmark
+
+    scenarios = [(name, json.dumps(event).encode()) for name, event in benchmark.generate_scenarios()]
+    rng = random.Random(args.seed)
+    corpus = [rng.choice(scenarios) for _ in range(args.count)]
+
+    expected = None
+    if args.verify:
+        if lambda_function.get_availability_backend().shared:
+            sys.exit('--verify needs the default backend; bookings on a shared backend change the answers')
+        expected = {name: invoke(json.loads(body), 'verify') for name, body in scenarios}
+
+    processes = []
+    if args.target:
+        host, _, port = args.target.rpartition(':')
+        port = int(port)
+    else:
+        host, port = '127.0.0.1', args.port
+        processes = start_workers(host, port, args.workers)
+    try:
+        elapsed, latencies, mismatches = asyncio.run(load_test(host, port, corpus, args.concurrency, expected))
+    finally:
+        stop_workers(processes)
+
+    latencies.sort()
+    print('{} requests over {} connections in {:.2f} s'.format(len(latencies), args.concurrency, elapsed))
+    print('{:<12} {:10.0f}'.format('requests/s', len(latencies) / elapsed))
+    print('{:<12} {:10.3f} ms'.format('p50', statistics.median(latencies) * 1000))
+    print('{:<12} {:10.3f} ms'.format('p99', benchmark.percentile(latencies, 0.99) * 1000))
+    if mismatches:
+        for name, problem in mismatches[:10]:
+            print('{}: {}'.format(name, problem))
+        sys.exit('{} of {} responses were not as expected'.format(len(mismatches), len(latencies)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve = subparsers.add_parser('serve', help='serve lambda_handler over HTTP')
+    serve.add_argument('--host', default='0.0.0.0')
+    serve.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8080)))
+    serve.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes sharing the port')
+    serve.set_defaults(func=run_serve)
+
+    loadtest = subparsers.add_parser('loadtest', help='drive a local server with generated Lex events')
+    loadtest.add_argument('--target', help='HOST:PORT of a running server (default: start one locally)')
+    loadtest.add_argument('--port', type=int, default=8081, help='port of the locally started server')
+    loadtest.add_argument('--workers', type=int, default=2, help='worker processes of the locally started server')
+    loadtest.add_argument('--concurrency', type=int, default=64, help='concurrent keep-alive connections')
+    loadtest.add_argument('--count', type=int, default=20000)
+    loadtest.add_argument('--seed', type=int, default=0)
+    loadtest.add_argument('--verify', action='store_true', help='compare each response with lambda_handler in-process')
+    loadtest.set_defaults(func=run_loadtest)
+
+    args = parser.parse_args(argv)
+    lambda_function.configure_local_logging()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()